@@ -0,0 +1,299 @@
+'''
+Single pass grouped aggregates over fmt4 records.
+
+Records are decoded in batches and grouped on header fields (plus the
+derived birth_year and calving_year); for every value field each group
+keeps
+	count, mean and M2 (Welford), combined batch to batch with Chan's
+		parallel formula
+	min and max
+	a merging t-digest, centroids being re-clustered with the arcsine scale
+		function so the tails keep the finest resolution
+Values are header fields or, with the fmt4_columnar 'seg_' prefix, test day
+fields (seg_actual_SCS, ...), which are grouped by the key of their record.
+Missing values are left out. GroupedStats of different shards merge into
+the same counts, means and variances as one pass over the whole file; the
+merged digests are deterministic for a given shard split.
+'''
+
+import argparse
+import csv
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from fmt4_columnar import SEGMENT_PREFIX
+from fmt4_decode import decode_batch, record_batches
+from fmt4_filter import Fmt4Filter
+from fmt4_layout import HEADER_FIELDS, HEADER_NAMES, MISSING, MISSING_DATE, SEGMENT_FIELDS, header_projection, segment_projection
+from fmt4_reader import Fmt4Reader, open_fmt4
+
+# derived key: source date field
+DERIVED_KEYS = {'birth_year': 'birth_date', 'calving_year': 'calving_date'}
+
+HEADER_KINDS = dict((name, kind) for name, offset, width, kind in HEADER_FIELDS)
+SEGMENT_KINDS = dict((name, kind) for name, offset, width, kind in SEGMENT_FIELDS)
+# kinds that can be summarised as numbers
+NUMERIC_KINDS = ('int', 'date')
+
+
+def _years(days):
+	years = days.astype('M8[D]').astype('M8[Y]').astype(np.int64) + 1970
+	return np.where(days == MISSING_DATE, MISSING, years).astype(np.int32)
+
+
+def _key_value(kind, value):
+	# value as given by tolist(): bytes for str fields, int for the others
+	if kind == 'str':
+		return value.decode('ascii')
+	if kind == 'code':
+		return chr(value)
+	return value
+
+
+class GroupedStats(object):
+	'''
+		Description:
+			mergeable per group statistics of value fields
+		Input:
+			keys: header field names (or DERIVED_KEYS) to group by
+			values: int or date header field names, or 'seg_' + int segment field name
+			compression: t-digest compression, about the number of centroids per group
+	'''
+	def __init__(self, keys, values, compression=100):
+		unknown = [name for name in keys if name not in HEADER_NAMES and name not in DERIVED_KEYS]
+		unknown += [name for name in values if name not in HEADER_NAMES and
+			not (name.startswith(SEGMENT_PREFIX) and name[len(SEGMENT_PREFIX):] in SEGMENT_KINDS)]
+		if unknown:
+			raise ValueError('unknown fmt4 fields {}'.format(unknown))
+		not_numeric = [name for name in values if (HEADER_KINDS[name] if name in HEADER_KINDS
+			else SEGMENT_KINDS[name[len(SEGMENT_PREFIX):]]) not in NUMERIC_KINDS]
+		if not_numeric:
+			raise ValueError('not numeric fmt4 fields {}'.format(not_numeric))
+		self.keys = list(keys)
+		self.values = list(values)
+		self.compression = compression
+		self.groups = []
+		self._index = {}
+		shape = (len(self.values), 0)
+		self.count = np.zeros(shape)
+		self.mean = np.zeros(shape)
+		self.m2 = np.zeros(shape)
+		self.min = np.zeros(shape)
+		self.max = np.zeros(shape)
+		# per value: (group, mean, weight) of the centroids, sorted by group then mean
+		self.digests = [(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)) for name in self.values]
+
+	def header_fields(self):
+		'''
+			Description:
+				header fields to decode for the keys and values
+		'''
+		names = [DERIVED_KEYS.get(name, name) for name in self.keys] + [name for name in self.values if name in HEADER_NAMES]
+		return list(dict.fromkeys(names))
+
+	def segment_fields(self):
+		return list(dict.fromkeys(name[len(SEGMENT_PREFIX):] for name in self.values if name not in HEADER_NAMES))
+
+	def _group_ids(self, groups):
+		ids = []
+		for group in groups:
+			if group not in self._index:
+				self._index[group] = len(self.groups)
+				self.groups.append(group)
+			ids.append(self._index[group])
+		grow = len(self.groups) - self.count.shape[1]
+		if grow:
+			pad = np.zeros((len(self.values), grow))
+			self.count = np.hstack([self.count, pad])
+			self.mean = np.hstack([self.mean, pad])
+			self.m2 = np.hstack([self.m2, pad])
+			self.min = np.hstack([self.min, pad + np.inf])
+			self.max = np.hstack([self.max, pad - np.inf])
+		return np.array(ids, dtype=np.int64)
+
+	def _combine(self, v, ids, count, mean, m2, low, high):
+		# Chan et al. pairwise update, ids are distinct
+		count_a = self.count[v, ids]
+		total = count_a + count
+		with np.errstate(invalid='ignore', divide='ignore'):
+			delta = mean - self.mean[v, ids]
+			share = np.where(total > 0, count / total, 0)
+			self.mean[v, ids] += delta * share
+			self.m2[v, ids] += m2 + delta ** 2 * count_a * share
+		self.count[v, ids] = total
+		self.min[v, ids] = np.minimum(self.min[v, ids], low)
+		self.max[v, ids] = np.maximum(self.max[v, ids], high)
+
+	def _compress(self, group, mean, weight):
+		order = np.lexsort((mean, group))
+		group, mean, weight = group[order], mean[order], weight[order]
+		if not len(group):
+			return group, mean, weight
+		starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+		runs = np.diff(np.r_[starts, len(group)])
+		cum = np.cumsum(weight)
+		before = np.repeat(cum[starts] - weight[starts], runs)
+		total = np.repeat(cum[np.r_[starts[1:], len(group)] - 1], runs) - before
+		q = (cum - before - weight / 2) / total
+		k = np.floor(self.compression / (2 * np.pi) * np.arcsin(np.clip(2 * q - 1, -1, 1)))
+		bounds = np.flatnonzero(np.r_[True, (group[1:] != group[:-1]) | (k[1:] != k[:-1])])
+		new_weight = np.add.reduceat(weight, bounds)
+		return group[bounds], np.add.reduceat(weight * mean, bounds) / new_weight, new_weight
+
+	def _add_digest(self, v, group, mean, weight):
+		old_group, old_mean, old_weight = self.digests[v]
+		self.digests[v] = self._compress(np.r_[old_group, group], np.r_[old_mean, mean], np.r_[old_weight, weight])
+
+	def add(self, columns, seg_columns, seg_index):
+		'''
+			Description:
+				add a decoded batch (fmt4_decode.decode_batch output)
+		'''
+		key_columns = [_years(columns[DERIVED_KEYS[name]]) if name in DERIVED_KEYS else columns[name] for name in self.keys]
+		if self.keys:
+			table = np.rec.fromarrays(key_columns, names=['k{}'.format(k) for k in range(len(self.keys))])
+			unique, inverse = np.unique(table, return_inverse=True)
+			kinds = [HEADER_KINDS.get(name, 'int') for name in self.keys]
+			groups = [tuple(_key_value(kind, value) for kind, value in zip(kinds, row)) for row in unique.tolist()]
+			ids = self._group_ids(groups)
+		else:
+			inverse = np.zeros(len(seg_index) - 1, dtype=np.int64)
+			ids = self._group_ids([()])
+		inverse = inverse.ravel()
+		for v, name in enumerate(self.values):
+			if name in HEADER_NAMES:
+				x, g = columns[name], inverse
+			else:
+				x, g = seg_columns[name[len(SEGMENT_PREFIX):]], np.repeat(inverse, np.diff(seg_index))
+			valid = (x != MISSING) & (x != MISSING_DATE)
+			x = x[valid].astype(np.float64)
+			g = g[valid]
+			order = np.lexsort((x, g))
+			x, g = x[order], g[order]
+			starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]]) if len(g) else np.zeros(0, dtype=np.int64)
+			present = g[starts]
+			count = np.diff(np.r_[starts, len(g)]).astype(np.float64)
+			mean = np.add.reduceat(x, starts) / count if len(g) else np.zeros(0)
+			m2 = np.add.reduceat((x - np.repeat(mean, count.astype(np.int64))) ** 2, starts) if len(g) else np.zeros(0)
+			high = x[np.r_[starts[1:], len(g)] - 1] if len(g) else np.zeros(0)
+			self._combine(v, ids[present], count, mean, m2, x[starts], high)
+			self._add_digest(v, ids[g], x, np.ones(len(x)))
+
+	def merge(self, other):
+		'''
+			Description:
+				fold in the statistics of other (same keys and values), e.g. of another shard
+		'''
+		if other.keys != self.keys or other.values != self.values:
+			raise ValueError('cannot merge statistics of different keys or values')
+		ids = self._group_ids(other.groups)
+		for v in range(len(self.values)):
+			self._combine(v, ids, other.count[v], other.mean[v], other.m2[v], other.min[v], other.max[v])
+			group, mean, weight = other.digests[v]
+			self._add_digest(v, ids[group], mean, weight)
+
+	def quantiles(self, v, qs):
+		'''
+			Description:
+				(groups x len(qs)) estimated quantiles of the v-th value
+		'''
+		group, mean, weight = self.digests[v]
+		out = np.full((len(self.groups), len(qs)), np.nan)
+		bounds = np.searchsorted(group, np.arange(len(self.groups) + 1))
+		for g in range(len(self.groups)):
+			w = weight[bounds[g]:bounds[g+1]]
+			if not len(w):
+				continue
+			cum = np.cumsum(w)
+			xs = np.r_[0, cum - w / 2, cum[-1]]
+			ys = np.r_[self.min[v, g], mean[bounds[g]:bounds[g+1]], self.max[v, g]]
+			out[g] = np.interp(np.asarray(qs) * cum[-1], xs, ys)
+		return out
+
+	def rows(self, qs=(0.5,)):
+		'''
+			Description:
+				one dict per group: the key fields then <value>_count, _mean,
+				_std, _min, _max and _q<percent> for every value
+		'''
+		with np.errstate(invalid='ignore', divide='ignore'):
+			std = np.sqrt(self.m2 / (self.count - 1))
+		quantiles = [self.quantiles(v, qs) for v in range(len(self.values))]
+		for g, group in enumerate(self.groups):
+			row = dict(zip(self.keys, group))
+			for v, name in enumerate(self.values):
+				has = self.count[v, g] > 0
+				row[name + '_count'] = int(self.count[v, g])
+				row[name + '_mean'] = float(self.mean[v, g]) if has else None
+				row[name + '_std'] = float(std[v, g]) if self.count[v, g] > 1 else None
+				row[name + '_min'] = float(self.min[v, g]) if has else None
+				row[name + '_max'] = float(self.max[v, g]) if has else None
+				for q, value in zip(qs, quantiles[v][g]):
+					row['{}_q{:g}'.format(name, q * 100)] = float(value) if has else None
+			yield row
+
+
+def aggregate_range(reader, stats, start=0, end=None, predicate=None, batch_size=100000):
+	'''
+		Description:
+			add the records of reader from start to end to stats
+	'''
+	projection = header_projection(stats.header_fields())
+	seg_fields = stats.segment_fields()
+	seg_projection = segment_projection(seg_fields) if seg_fields else None
+	for data, offsets, seg_counts, base in record_batches(reader, batch_size, start, end, predicate):
+		stats.add(*decode_batch(data, offsets, seg_counts, projection, seg_projection))
+	return stats
+
+
+def _aggregate_shard(args):
+	path, keys, values, compression, start, end, predicate, batch_size = args
+	with Fmt4Reader(path) as reader:
+		return aggregate_range(reader, GroupedStats(keys, values, compression), start, end, predicate, batch_size)
+
+
+def aggregate(paths, keys, values, predicate=None, workers=1, compression=100, batch_size=100000):
+	'''
+		Description:
+			GroupedStats of values grouped by keys over the fmt4 files in paths
+		Input:
+			predicate: Fmt4Filter (or any reader predicate) applied before decoding
+			workers: processes per uncompressed file, shard results are
+				merged in file order
+	'''
+	stats = GroupedStats(keys, values, compression)
+	for path in paths:
+		with open_fmt4(path) as reader:
+			# compressed inputs can only be read sequentially
+			if workers <= 1 or not isinstance(reader, Fmt4Reader):
+				aggregate_range(reader, stats, predicate=predicate, batch_size=batch_size)
+				continue
+			bounds = reader.shard_boundaries(workers)
+		shards = [(path, keys, values, compression, bounds[k], bounds[k+1], predicate, batch_size)
+			for k in range(len(bounds) - 1)]
+		with ProcessPoolExecutor(workers) as pool:
+			for shard_stats in pool.map(_aggregate_shard, shards):
+				stats.merge(shard_stats)
+	return stats
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='grouped statistics of fmt4 fields')
+	parser.add_argument('inputs', nargs='+')
+	parser.add_argument('--by', default='', help='comma separated header fields to group by, e.g. herd_state_code,lactation_num')
+	parser.add_argument('--values', required=True, help='comma separated int/date header fields or seg_<int test day field>')
+	parser.add_argument('--quantiles', default='0.5', help='comma separated quantiles to estimate')
+	parser.add_argument('--compression', type=int, default=100, help='t-digest compression')
+	parser.add_argument('--where', action='append', default=[], help='filter clause, see fmt4_csv --where')
+	parser.add_argument('--workers', type=int, default=1, help='processes per uncompressed input')
+	args = parser.parse_args()
+	keys = [name for name in args.by.split(',') if name]
+	qs = [float(q) for q in args.quantiles.split(',')]
+	predicate = Fmt4Filter.parse(args.where) if args.where else None
+	stats = aggregate(args.inputs, keys, args.values.split(','), predicate, args.workers, args.compression)
+	rows = sorted(stats.rows(qs), key=lambda row: [str(row[name]) for name in keys])
+	w = csv.DictWriter(sys.stdout, list(rows[0]) if rows else keys)
+	w.writeheader()
+	w.writerows(rows)
@@ -0,0 +1,221 @@
+'''
+Throughput benchmark of the fmt4 parsing pipeline.
+
+Each stage runs over each fixture file in a fresh process, so the reported
+peak RSS belongs to that stage alone:
+	read: walk the records with Fmt4Reader
+	filter: walk the records through fmt4_csv.default_filter
+	decode: decode every header and segment field with fmt4_decode
+	write: csv writing of already unpacked rows (unpacking is not timed)
+	convert: the whole fmt4_csv conversion, unfiltered, to a temporary file
+Results are printed (or written) as JSON, one object per fixture and stage
+with seconds, MB/s, records/s, segments/s and peak RSS in MB; the best of
+--repeat runs is kept. Without fixture files, synthetic fixtures of the
+--synthetic sizes are generated with fmt4_synth into a temporary directory.
+'''
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from fmt4_csv import convert, default_filter, default_columns
+from fmt4_decode import decode_batch, record_batches
+from fmt4_layout import header_projection, segment_projection
+from fmt4_reader import Fmt4Reader, segments
+from fmt4_synth import generate, parse_size
+
+STAGES = ['read', 'filter', 'decode', 'write', 'convert']
+SYNTHETIC_SIZES = ['1M', '10M', '100M']
+
+
+def _read(path):
+	with Fmt4Reader(path) as reader:
+		for offset, rec in reader.records():
+			pass
+
+
+def _filter(path):
+	with Fmt4Reader(path) as reader:
+		for offset, rec in reader.records(predicate=default_filter):
+			pass
+
+
+def _decode(path):
+	with Fmt4Reader(path) as reader:
+		for data, offsets, seg_counts, base in record_batches(reader, 10000):
+			decode_batch(data, offsets, seg_counts)
+
+
+def _write(path):
+	# only the csv writer is timed
+	projection = header_projection(default_columns)
+	seg_projection = segment_projection()
+	elapsed = 0.0
+	with Fmt4Reader(path) as reader, open(os.devnull, 'w', newline='') as output_f:
+		w = csv.writer(output_f)
+		rows = []
+		for offset, rec in reader.records():
+			rows.append([offset] + projection.unpack_str(rec))
+			rows.extend([offset, j] + seg_projection.unpack_str(seg) for j, seg in enumerate(segments(rec)))
+			if len(rows) >= 10000:
+				start = time.perf_counter()
+				w.writerows(rows)
+				elapsed += time.perf_counter() - start
+				rows = []
+		start = time.perf_counter()
+		w.writerows(rows)
+		elapsed += time.perf_counter() - start
+	return elapsed
+
+
+def _convert(path):
+	# a real file: the checkpoint written next to the output cannot live beside os.devnull
+	with tempfile.TemporaryDirectory(prefix='fmt4_bench_') as out_dir:
+		convert(path, os.path.join(out_dir, 'out.csv'), None, record_filter=None, checkpoint_every=0)
+
+
+_STAGE_FUNCTIONS = {'read': _read, 'filter': _filter, 'decode': _decode, 'write': _write, 'convert': _convert}
+
+
+def _run_stage(stage, path, results):
+	try:
+		start = time.perf_counter()
+		elapsed = _STAGE_FUNCTIONS[stage](path)
+		if elapsed is None:
+			elapsed = time.perf_counter() - start
+	except BaseException:
+		# the parent is waiting on results, it must hear about the failure
+		results.put(('error', traceback.format_exc()))
+		return
+	results.put(('ok', (elapsed, peak_rss())))
+
+
+def peak_rss():
+	'''
+		Description:
+			peak resident set size of this process in bytes
+	'''
+	# Linux carries ru_maxrss over fork + exec, so a spawned stage would report
+	# its launcher's peak; VmHWM is this process's own high-water mark
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	# ru_maxrss is in kilobytes on Linux and bytes on macOS
+	scale = 1 if sys.platform == 'darwin' else 1024
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _stage_result(stage, path, process, results):
+	while True:
+		try:
+			status, value = results.get(timeout=1.0)
+			break
+		except queue.Empty:
+			# killed without a word (signal, out of memory)
+			if process.exitcode is not None and results.empty():
+				raise RuntimeError('{} stage on {} died with exit code {}'.format(stage, path, process.exitcode))
+	if status == 'error':
+		raise RuntimeError('{} stage on {} failed:\n{}'.format(stage, path, value))
+	return value
+
+
+def run_stage(stage, path, repeat=1):
+	'''
+		Description:
+			best (seconds, peak RSS bytes) of repeat runs of stage over path,
+			each run in a freshly spawned process
+	'''
+	ctx = multiprocessing.get_context('spawn')
+	best = None
+	for k in range(repeat):
+		results = ctx.Queue()
+		process = ctx.Process(target=_run_stage, args=(stage, path, results))
+		process.start()
+		try:
+			elapsed, peak_rss = _stage_result(stage, path, process, results)
+		finally:
+			process.join()
+		if best is None or elapsed < best[0]:
+			best = (elapsed, peak_rss)
+	return best
+
+
+def benchmark(paths, stages=STAGES, repeat=1):
+	results = []
+	for path in paths:
+		size = os.path.getsize(path)
+		with Fmt4Reader(path) as reader:
+			n_records, n_segments = reader.count()
+		for stage in stages:
+			elapsed, peak_rss = run_stage(stage, path, repeat)
+			elapsed = max(elapsed, 1e-9)
+			results.append({
+				'fixture': path,
+				'bytes': size,
+				'records': n_records,
+				'segments': n_segments,
+				'stage': stage,
+				'seconds': round(elapsed, 6),
+				'mb_per_s': round(size / elapsed / 1e6, 3),
+				'records_per_s': round(n_records / elapsed, 1),
+				'segments_per_s': round(n_segments / elapsed, 1),
+				'peak_rss_mb': round(peak_rss / 1e6, 1),
+			})
+	return results
+
+
+def synthetic_fixtures(sizes, out_dir, seed=0):
+	'''
+		Description:
+			write one synthetic fmt4 fixture per size ('10M', '1G', ...) into out_dir
+		Output:
+			list of fixture paths
+	'''
+	paths = []
+	for size in sizes:
+		path = os.path.join(out_dir, 'synthetic_{}.fmt4'.format(size))
+		generate(path, parse_size(size), seed=seed)
+		paths.append(path)
+	return paths
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='benchmark the fmt4 parsing stages')
+	parser.add_argument('fixtures', nargs='*', help='fmt4 files, ideally of several sizes')
+	parser.add_argument('--stages', default=','.join(STAGES), help='comma separated subset of ' + ','.join(STAGES))
+	parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the fastest is reported')
+	parser.add_argument('--output', help='write the JSON here instead of stdout')
+	parser.add_argument('--synthetic', default=','.join(SYNTHETIC_SIZES),
+		help='sizes of the synthetic fixtures used when no fixture is given')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic fixtures')
+	args = parser.parse_args()
+	fixture_dir = None
+	if args.fixtures:
+		fixtures = args.fixtures
+	else:
+		fixture_dir = tempfile.mkdtemp(prefix='fmt4_bench_')
+		fixtures = synthetic_fixtures(args.synthetic.split(','), fixture_dir, args.seed)
+	try:
+		results = benchmark(fixtures, args.stages.split(','), args.repeat)
+	finally:
+		if fixture_dir is not None:
+			shutil.rmtree(fixture_dir, ignore_errors=True)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1)
+	else:
+		json.dump(results, sys.stdout, indent=1)
+		print()
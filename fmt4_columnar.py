@@ -0,0 +1,95 @@
+'''
+Columnar NumPy export of fmt4 files.
+
+export_columns writes one .npy file per decoded header field, the source
+record offsets, and the test day segments as flat seg_<field>.npy arrays
+with seg_index.npy (records + 1 entries) delimiting the segments of each
+record. load_columns reopens them with mmap_mode='r', so analyses start
+without parsing and processes share the same pages.
+'''
+
+import argparse
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from fmt4_decode import decode_batch, record_batches
+from fmt4_layout import HEADER_FIELDS, SEGMENT_FIELDS, field_dtype
+from fmt4_reader import Fmt4Reader
+
+SEGMENT_PREFIX = 'seg_'
+
+
+def export_columns(path, out_dir, batch_size=100000):
+	'''
+		Description:
+			decode every record of the fmt4 file at path into out_dir
+		Output:
+			number of records exported
+	'''
+	if not os.path.isdir(out_dir):
+		os.makedirs(out_dir)
+
+	def column(name, dtype, length):
+		return open_memmap(os.path.join(out_dir, name + '.npy'), mode='w+', dtype=dtype, shape=(length,))
+
+	with Fmt4Reader(path) as reader:
+		n_records, n_segments = reader.count()
+		columns = dict((name, column(name, field_dtype(kind, width), n_records))
+			for name, offset, width, kind in HEADER_FIELDS)
+		seg_columns = dict((name, column(SEGMENT_PREFIX + name, field_dtype(kind, width), n_segments))
+			for name, offset, width, kind in SEGMENT_FIELDS)
+		offset_column = column('offset', np.int64, n_records)
+		seg_index = column(SEGMENT_PREFIX + 'index', np.int64, n_records + 1)
+		seg_index[0] = 0
+
+		row = 0
+		seg_row = 0
+		for data, offsets, seg_counts, base in record_batches(reader, batch_size):
+			batch, seg_batch, batch_index = decode_batch(data, offsets, seg_counts)
+			n = len(offsets)
+			n_seg = batch_index[-1]
+			for name in columns:
+				columns[name][row:row+n] = batch[name]
+			for name in seg_columns:
+				seg_columns[name][seg_row:seg_row+n_seg] = seg_batch[name]
+			offset_column[row:row+n] = offsets
+			seg_index[row+1:row+n+1] = seg_row + batch_index[1:]
+			row += n
+			seg_row += n_seg
+
+	for array in list(columns.values()) + list(seg_columns.values()) + [offset_column, seg_index]:
+		array.flush()
+	return n_records
+
+
+def load_columns(out_dir, mmap_mode='r'):
+	'''
+		Description:
+			reload an export_columns directory
+		Output:
+			(columns, seg_columns, seg_index) laid out like fmt4_decode.decode_batch,
+			columns also holds the source record 'offset'
+	'''
+	columns = {}
+	seg_columns = {}
+	for file_name in sorted(os.listdir(out_dir)):
+		if not file_name.endswith('.npy'):
+			continue
+		name = file_name[:-len('.npy')]
+		array = np.load(os.path.join(out_dir, file_name), mmap_mode=mmap_mode)
+		if name.startswith(SEGMENT_PREFIX):
+			seg_columns[name[len(SEGMENT_PREFIX):]] = array
+		else:
+			columns[name] = array
+	seg_index = seg_columns.pop('index')
+	return columns, seg_columns, seg_index
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='export an fmt4 file as NumPy columns')
+	parser.add_argument('input')
+	parser.add_argument('out_dir')
+	args = parser.parse_args()
+	print(export_columns(args.input, args.out_dir))
@@ -1,204 +1,360 @@
+import argparse
 import csv
+import itertools
 import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 
-CHUNCK_SIZE = 10**5
-byte_array = []
-
-def parse_header_1(byte_array, i, row):
-	keep = True
-	# row.append(''.join(map(str, byte_array[i])))
-	# row.append(''.join(map(str, byte_array[i+1])))
-	row.append(''.join(map(str, byte_array[i+2:i+4])))
-	# row.append(''.join(map(str, byte_array[i+4:i+7])))
-	row.append(''.join(map(str, byte_array[i+7:i+19])))
-	# row.append(''.join(map(str, byte_array[i+19:i+21])))
-	# row.append(''.join(map(str, byte_array[i+21:i+24])))
-	# row.append(''.join(map(str, byte_array[i+24:i+36])))
-	# row.append(''.join(map(str, byte_array[i+36:i+38])))
-	# row.append(''.join(map(str, byte_array[i+38:i+41])))
-	# row.append(''.join(map(str, byte_array[i+41:i+53])))
-	# row.append(''.join(map(str, byte_array[i+53:i+55])))
-	# row.append(''.join(map(str, byte_array[i+55:i+58])))
-	# row.append(''.join(map(str, byte_array[i+58:i+70])))
-	row.append(''.join(map(str, byte_array[i+70:i+78])))
-	if (''.join(map(str, byte_array[i+70:i+74])) < '2008'):
-		keep = False
-	# row.append(''.join(map(str, byte_array[i+78])))
-	# row.append(''.join(map(str, byte_array[i+79:i+87])))
-	# row.append(''.join(map(str, byte_array[i+87])))
-	# row.append(''.join(map(str, byte_array[i+88])))
-	# row.append(''.join(map(str, byte_array[i+89])))
-	row.append(''.join(map(str, byte_array[i+90:i+91])))
-	# row.append(''.join(map(str, byte_array[i+91:i+93])))
-	# row.append(''.join(map(str, byte_array[i+93:i+99])))
-	# row.append(''.join(map(str, byte_array[i+99])))
-	# row.append(''.join(map(str, byte_array[i+100])))
-	# row.append(''.join(map(str, byte_array[i+101:i+103])))
-	# row.append(''.join(map(str, byte_array[i+103:i+106])))
-	row.append(''.join(map(str, byte_array[i+106:i+108])))
-	row.append(''.join(map(str, byte_array[i+108:i+110])))
-	# row.append(''.join(map(str, byte_array[i+110:i+114])))
-	row.append(''.join(map(str, byte_array[i+114:i+119])))
-	row.append(''.join(map(str, byte_array[i+119:i+125])))
-	row.append(''.join(map(str, byte_array[i+125:i+126])))
-	
-
-
-	return ''.join(map(str, byte_array[i+87:i+88])), ''.join(map(str, byte_array[i+125:i+126])), keep
-
-
-def parse_header_2(byte_array, i, row):
-	row.append(''.join(map(str, byte_array[i:i+1])))
-	row.append(''.join(map(str, byte_array[i+1:i+9])))
-	row.append(''.join(map(str, byte_array[i+9:i+12])))
-	row.append(''.join(map(str, byte_array[i+12:i+15])))
-	# row.append(''.join(map(str, byte_array[i+15:i+17])))
-	# row.append(''.join(map(str, byte_array[i+17:i+20])))
-	row.append(''.join(map(str, byte_array[i+20:i+24])))
-	row.append(''.join(map(str, byte_array[i+24:i+28])))
-	row.append(''.join(map(str, byte_array[i+28:i+32])))
-	row.append(''.join(map(str, byte_array[i+32:i+34])))
-	row.append(''.join(map(str, byte_array[i+34:i+35])))
-	row.append(''.join(map(str, byte_array[i+35:i+43])))
-	row.append(''.join(map(str, byte_array[i+43:i+46])))
-	row.append(''.join(map(str, byte_array[i+46:i+47])))
-	row.append(''.join(map(str, byte_array[i+47:i+48])))
-	row.append(''.join(map(str, byte_array[i+48:i+49])))
-	row.append(''.join(map(str, byte_array[i+49:i+51])))
-	row.append(''.join(map(str, byte_array[i+51:i+52])))
-	# row.append(''.join(map(str, byte_array[i+52:i+57])))
-	# row.append(''.join(map(str, byte_array[i+57:i+58])))
-	row.append(''.join(map(str, byte_array[i+58:i+59])))
-	row.append(''.join(map(str, byte_array[i+59:i+60])))
-	row.append(''.join(map(str, byte_array[i+60:i+61])))
-	row.append(''.join(map(str, byte_array[i+61:i+66])))
-	row.append(''.join(map(str, byte_array[i+66:i+70])))
-	row.append(''.join(map(str, byte_array[i+70:i+74])))
-	# row.append(''.join(map(str, byte_array[i+74:i+80])))
-	# row.append(''.join(map(str, byte_array[i+80:i+85])))
-	# row.append(''.join(map(str, byte_array[i+85:i+90])))
-	# row.append(''.join(map(str, byte_array[i+90:i+94])))
-	# row.append(''.join(map(str, byte_array[i+94:i+101])))
-	# row.append(''.join(map(str, byte_array[i+101:i+105])))
-	# row.append(''.join(map(str, byte_array[i+105:i+107])))
-	row.append(''.join(map(str, byte_array[i+107:i+109])))
-	row.append(''.join(map(str, byte_array[i+109:i+112])))
-	row.append(''.join(map(str, byte_array[i+112:i+115])))
-	row.append(''.join(map(str, byte_array[i+115:i+116])))
-	row.append(''.join(map(str, byte_array[i+116:i+117])))
-	row.append(''.join(map(str, byte_array[i+117:i+118])))
-	#row.append(''.join(map(str, byte_array[i+244:i+248])))
-	row.append(''.join(map(str, byte_array[i+122:i+124])))
-
-	return ''.join(map(str, byte_array[i+122:i+124]))
-
-
-def parse_data(byte_array, i, segment):
-	segment['dim_test'] = ''.join(map(str, byte_array[i:i+3]))
-	segment['supervision_code'] = ''.join(map(str, byte_array[i+3]))
-	segment['last_test_status_code'] = ''.join(map(str, byte_array[i+4]))
-	segment['milking_freq'] = ''.join(map(str, byte_array[i+5]))
-	segment['num_milking_weighted'] = ''.join(map(str, byte_array[i+6]))
-	segment['num_milking_sample'] = ''.join(map(str, byte_array[i+7]))
-	segment['num_MRD'] = ''.join(map(str, byte_array[i+8:i+10]))
-	segment['percent_milk_shipped'] = ''.join(map(str, byte_array[i+10:i+13]))
-	segment['actual_milk_yield'] = ''.join(map(str, byte_array[i+13:i+17]))
-	segment['actual_fat_percent'] = ''.join(map(str, byte_array[i+17:i+19]))
-	segment['actual_protein_percent'] = ''.join(map(str, byte_array[i+19:i+21]))
-	segment['actual_SCS'] = ''.join(map(str, byte_array[i+21:i+23]))
-
-def check_size(size, byte_array, arr_length, i, f):
-	if (i + size > arr_length):
-		temp_array = f.read(CHUNCK_SIZE - size)
-		# print(byte_array[i:])
-		# print(type(byte_array[i:]))
-		byte_array = byte_array[i:] + temp_array
-		arr_length = len(byte_array)
-		i = 0
-
-	return byte_array, i, arr_length
-
-output_f = open("reed20180705_2.csv", 'w')
-w = csv.writer(output_f)
-header = [
-		  'animal_breed_code',
-		  'animal_id_number',
-		  'birth_date(YYYMMDD)',
-		  'multiple_birth_code',
-		  'herd_state_code',
-		  'herd_county_code',
-		  'cow_ctrl_number',
-		  'date_cow_left(YYMMDD)',
-		  'lactation_type_code',
-		  'lactation_verify_code',
-		  'calving_date(YYYYMMDD)',
-		  'DIM',
-		  'days_dry_prior',
-		  'actual_milk_yield/10',
-		  'actual_fat_yield',
-		  'actual_protein_yield',
-		  'lactation_num',
-		  'primary_dest_group/term_code',
-		  'date_breeding_conception(YYYYMMDD)',
-		  'body_weight_start',
-		  'weight_report_code',
-		  'lactation_init_code',
-		  'milking/dry_status',
-		  'type_of_test_plan_code',
-		  'type_lactation_sc_score',
-		  'true_protein_code',
-		  'test_method_code',
-		  'qc_status',
-		  'lactation_std_milk_yield',
-		  'lactation_std_fat_yield',
-		  'lactation_std_protein_yield',
-		  'num_tests_components_taken',
-		  'DCR_for_yield',
-		  'DCR_for_somatic_cell',
-		  'preg_confirm_code',
-		  'num_progeny_born',
-		  'second_term_code',
-		  'num_seg_test_days',
-		  'seg_data(JSON)']
-
-w.writerow(header)
-
-count = 0
-i = 0
-
-with open("reed20180705.fmt4", "rb") as f:
-	byte_array = f.read(CHUNCK_SIZE)
-	arr_length = len(byte_array)
-	while arr_length != 0:
-		while (i < arr_length and byte_array[i] == '\n'):
-			i = i + 1
-		row = []
-		byte_array, i, arr_length = check_size(126, byte_array, arr_length, i, f)
-		while (i < arr_length and byte_array[i] == '\n'):
-			i = i + 1
-		if (arr_length == 0):
-			exit()
-		record_type, lactation_type, keep = parse_header_1(byte_array, i, row)
-		i = i + 126
-		if (record_type in ['X', 'L', 'R', 'Y', 'C'] and lactation_type in ['0', '1', '2', '5', '6', '7', '8']):
-			byte_array, i, arr_length = check_size(124, byte_array, arr_length, i, f)
-			seg_count = int(parse_header_2(byte_array, i, row))
-			segments = {}
-			i = i + 124
-			if (keep):
-				byte_array, i, arr_length = check_size(23*seg_count, byte_array, arr_length, i, f)
-				for j in range(seg_count):
-					seg_num = 'test_day' + str(j)
-					segments[seg_num] = {}
-					parse_data(byte_array, i, segments[seg_num])
-					i = i + 23
-				# row.append(str(segments).replace('\'', '\"'))
-				row.append(str(json.dumps(segments)))
-				w.writerow(row)
-				count = count + 1
-			else:
-				byte_array, i, arr_length = check_size(23*seg_count, byte_array, arr_length, i, f)
-				i = i + 23*seg_count
-
-		if (count == 30000):
-			exit()
+from fmt4_filter import Fmt4Filter
+from fmt4_layout import HEADER_NAMES, SEGMENT_NAMES, header_projection, segment_projection
+from fmt4_reader import Fmt4Reader, open_fmt4, segment_count, segments
+from fmt4_sample import SampledReader
+from fmt4_stats import NULL_STATS, ConversionStats
+
+# cows born 2008 or later with lactation related record and lactation types
+default_filter = Fmt4Filter(
+	birth_year=(2008, None),
+	record_type=['X', 'L', 'R', 'Y', 'C'],
+	lactation_type=['0', '1', '2', '5', '6', '7', '8'])
+
+# csv labels of the fmt4_layout fields whose names differ
+labels = {
+	'birth_date': 'birth_date(YYYMMDD)',
+	'date_cow_left': 'date_cow_left(YYMMDD)',
+	'calving_date': 'calving_date(YYYYMMDD)',
+	'actual_milk_yield': 'actual_milk_yield/10',
+	'primary_dest_group': 'primary_dest_group/term_code',
+	'date_breeding_conception': 'date_breeding_conception(YYYYMMDD)',
+	'milking_dry_status': 'milking/dry_status',
+}
+
+# every header field except record_type, which only feeds the filter
+default_columns = [name for name in HEADER_NAMES if name != 'record_type']
+
+
+def csv_header(columns):
+	return [labels.get(name, name) for name in columns]
+
+
+test_day_header = ['record_offset', 'test_day'] + SEGMENT_NAMES
+
+
+class Checkpoint(object):
+	'''
+		Description:
+			periodically records how far a conversion got: the input offset of
+			the next record, the rows written and the size of every output, so
+			a later run can truncate the outputs and carry on from there
+		Input:
+			path: checkpoint file, replaced atomically on every save
+			stamp: identifies the input (and shard) the checkpoint belongs to
+			output_fs: output files, flushed before their size is recorded
+			records_before: rows written by earlier runs
+			every: rows between two saves
+	'''
+	def __init__(self, path, stamp, output_fs, records_before=0, every=100000):
+		self.path = path
+		self.stamp = stamp
+		self.output_fs = output_fs
+		self.records_before = records_before
+		self.every = every
+		self._saved = 0
+
+	def update(self, input_offset, count):
+		if self.every and count - self._saved >= self.every:
+			self.save(input_offset, count)
+
+	def save(self, input_offset, count, done=False):
+		for output_f in self.output_fs:
+			output_f.flush()
+		state = dict(self.stamp)
+		state['input_offset'] = input_offset
+		state['records'] = self.records_before + count
+		state['output_pos'] = [output_f.tell() for output_f in self.output_fs]
+		state['done'] = done
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(state, f)
+		os.replace(tmp_path, self.path)
+		self._saved = count
+
+	def remove(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+
+def input_stamp(in_path, **extra):
+	st = os.stat(in_path)
+	stamp = {'input': os.path.abspath(in_path), 'input_size': st.st_size, 'input_mtime': st.st_mtime}
+	stamp.update(extra)
+	return stamp
+
+
+def open_outputs(paths, headers, stamp, resume=False, every=100000):
+	'''
+		Description:
+			open the csv outputs, either fresh with their headers or, when
+			resuming from a checkpoint of the same input, truncated back to
+			the last consistent record boundary
+		Output:
+			(output files, checkpoint, input offset to start at, rows already written, finished)
+	'''
+	checkpoint_path = paths[0] + '.ckpt'
+	state = None
+	if resume and os.path.exists(checkpoint_path):
+		with open(checkpoint_path) as f:
+			state = json.load(f)
+		if any(state.get(key) != value for key, value in stamp.items()):
+			raise ValueError('{} belongs to a different input'.format(checkpoint_path))
+	if state is None:
+		output_fs = [open(path, 'w', newline='') for path in paths]
+		for output_f, labels_row in zip(output_fs, headers):
+			csv.writer(output_f).writerow(labels_row)
+		start, done_count, finished = 0, 0, False
+	else:
+		output_fs = []
+		for path, pos in zip(paths, state['output_pos']):
+			output_f = open(path, 'r+', newline='')
+			output_f.seek(pos)
+			output_f.truncate()
+			output_fs.append(output_f)
+		start, done_count, finished = state['input_offset'], state['records'], state['done']
+	checkpoint = Checkpoint(checkpoint_path, stamp, output_fs, done_count, every)
+	return output_fs, checkpoint, start, done_count, finished
+
+
+def json_row(rec, projection, seg_projection, stats=NULL_STATS):
+	'''
+		Description:
+			csv row of one record: the projected header fields then its test days as one JSON object
+	'''
+	row = projection.unpack_str(rec)
+	seg_rows = [seg_projection.unpack_str(seg) for seg in segments(rec)]
+	stats.lap('decode')
+	segs = {}
+	for j, values in enumerate(seg_rows):
+		seg_num = 'test_day' + str(j)
+		segs[seg_num] = dict(zip(SEGMENT_NAMES, values))
+	# row.append(str(segs).replace('\'', '\"'))
+	row.append(str(json.dumps(segs)))
+	stats.lap('encode')
+	return row
+
+
+def convert_range(reader, output_f, start=0, end=None, limit=None, record_filter=default_filter, columns=default_columns,
+		checkpoint=None, stats=NULL_STATS):
+	count = 0
+	w = csv.writer(output_f)
+	projection = header_projection(columns)
+	seg_projection = segment_projection()
+	for offset, rec in reader.records(start, end, stats.counting(record_filter)):
+		stats.lap('read')
+		w.writerow(json_row(rec, projection, seg_projection, stats))
+		stats.lap('write')
+		stats.record(offset + len(rec), segment_count(rec))
+		count = count + 1
+		if (count == limit):
+			break
+		if checkpoint is not None:
+			checkpoint.update(offset + len(rec), count)
+	return count
+
+
+def convert_range_tables(reader, lactation_f, test_day_f, start=0, end=None, limit=None, record_filter=default_filter,
+		columns=default_columns, checkpoint=None, batch_size=10000, stats=NULL_STATS):
+	'''
+		Description:
+			write a lactation table and a long test day table, one row per
+			segment, linked by the byte offset of the record in the fmt4 file;
+			rows are flushed every batch_size lactations
+	'''
+	count = 0
+	lactation_w = csv.writer(lactation_f)
+	test_day_w = csv.writer(test_day_f)
+	projection = header_projection(columns)
+	seg_projection = segment_projection()
+	lactations = []
+	test_days = []
+	for offset, rec in reader.records(start, end, stats.counting(record_filter)):
+		stats.lap('read')
+		lactations.append([offset] + projection.unpack_str(rec))
+		for j, seg in enumerate(segments(rec)):
+			test_days.append([offset, j] + seg_projection.unpack_str(seg))
+		stats.lap('decode')
+		stats.record(offset + len(rec), segment_count(rec))
+		count = count + 1
+		if (count == limit):
+			break
+		if len(lactations) == batch_size:
+			lactation_w.writerows(lactations)
+			test_day_w.writerows(test_days)
+			stats.lap('write')
+			lactations = []
+			test_days = []
+			if checkpoint is not None:
+				checkpoint.update(offset + len(rec), count)
+	lactation_w.writerows(lactations)
+	test_day_w.writerows(test_days)
+	stats.lap('write')
+	return count
+
+
+def _convert_to(reader, output_fs, start, end, limit, record_filter, columns, checkpoint, stats):
+	if len(output_fs) == 1:
+		return convert_range(reader, output_fs[0], start, end, limit, record_filter, columns, checkpoint, stats)
+	return convert_range_tables(reader, output_fs[0], output_fs[1], start, end, limit, record_filter, columns, checkpoint,
+		stats=stats)
+
+
+def _convert_resumable(reader, out_paths, headers, stamp, start, end, limit, record_filter, columns, resume, every,
+		stats_path=None, stats_every=10.0):
+	output_fs, checkpoint, resume_at, count, finished = open_outputs(out_paths, headers, stamp, resume, every)
+	start = max(start, resume_at)
+	stats = NULL_STATS
+	if stats_path is not None:
+		stats = ConversionStats(stats_path, stats_every, start, input=stamp['input'], shard=stamp.get('shard'))
+	try:
+		if not finished and (limit is None or count < limit):
+			count += _convert_to(reader, output_fs, start, end,
+				None if limit is None else limit - count, record_filter, columns, checkpoint, stats)
+		checkpoint.save(end, count, done=True)
+	finally:
+		for output_f in output_fs:
+			output_f.close()
+	# a stream only knows its length once it has been read to the end
+	position = end if end is not None else getattr(reader, 'size', getattr(reader, 'consumed', None))
+	if limit is not None and count >= limit:
+		# cut short by limit, read only up to the last record written
+		position = None
+	stats.finish(position)
+	return count, checkpoint
+
+
+def _convert_shard(args):
+	in_path, part_paths, start, end, limit, record_filter, columns, resume, every, stats_path, stats_every = args
+	stamp = input_stamp(in_path, shard=[start, end])
+	with Fmt4Reader(in_path) as reader:
+		return _convert_resumable(reader, part_paths, [], stamp, start, end, limit, record_filter, columns, resume, every,
+			stats_path, stats_every)[0]
+
+
+def _rows_up_to(part_f, last_offset):
+	# test day rows whose record_offset is at most last_offset
+	for line in part_f:
+		if int(line[:line.index(',')]) > last_offset:
+			break
+		yield line
+
+
+def convert(in_path, out_path, limit=30000, workers=1, test_day_path=None, record_filter=default_filter,
+		columns=default_columns, resume=False, checkpoint_every=100000, stats_path=None, stats_every=10.0, sample=None,
+		strata=(), seed=0):
+	'''
+		Description:
+			convert an fmt4 file (or a gzip/bz2/xz compressed one) to csv,
+			keeping the first limit rows (all if None) or a random sample
+		Input:
+			workers: number of processes, the file is split into one shard per
+				worker at record boundaries and the shard outputs are
+				concatenated in file order
+			test_day_path: when given, out_path gets the lactation table and
+				test_day_path the test day table instead of a JSON column
+			record_filter: Fmt4Filter applied on the raw records, None keeps all
+			columns: fmt4_layout header fields to write, in order
+			resume: continue from the checkpoint left by an interrupted run
+				(<out_path>.ckpt, or one per shard part with workers)
+			checkpoint_every: rows between checkpoints, 0 disables them
+			stats_path: JSON-lines file receiving fmt4_stats counters every
+				stats_every seconds (one series per shard with workers)
+			sample: instead of the first limit rows, a uniform sample of this
+				many rows (per stratum with strata) drawn in one pass by
+				fmt4_sample, always sequential and without checkpoints
+			strata: fmt4_filter.CLAUSES names to stratify the sample by
+			seed: random seed of the sample
+	'''
+	out_paths = [out_path] if test_day_path is None else [out_path, test_day_path]
+	if test_day_path is None:
+		headers = [csv_header(columns) + ['seg_data(JSON)']]
+	else:
+		headers = [['record_offset'] + csv_header(columns), test_day_header]
+	with open_fmt4(in_path) as reader:
+		if sample is not None:
+			sampled = SampledReader(reader, sample, strata, seed)
+			stamp = input_stamp(in_path, sample=sample, strata=list(strata), seed=seed)
+			count, checkpoint = _convert_resumable(sampled, out_paths, headers, stamp, 0, None, None, record_filter, columns,
+				False, 0, stats_path, stats_every)
+			checkpoint.remove()
+			return count
+		# compressed inputs can only be read sequentially
+		if workers <= 1 or not isinstance(reader, Fmt4Reader):
+			count, checkpoint = _convert_resumable(reader, out_paths, headers, input_stamp(in_path), 0, None, limit,
+				record_filter, columns, resume, checkpoint_every, stats_path, stats_every)
+			checkpoint.remove()
+			return count
+		bounds = reader.shard_boundaries(workers)
+	shards = [(in_path, ['{}.part{}'.format(path, k) for path in out_paths], bounds[k], bounds[k+1], limit, record_filter,
+		columns, resume, checkpoint_every, stats_path, stats_every) for k in range(len(bounds) - 1)]
+	output_fs = [open(path, 'w', newline='') for path in out_paths]
+	try:
+		for output_f, labels_row in zip(output_fs, headers):
+			csv.writer(output_f).writerow(labels_row)
+		count = 0
+		with ProcessPoolExecutor(workers) as pool:
+			shard_counts = list(pool.map(_convert_shard, shards))
+		for shard, shard_count in zip(shards, shard_counts):
+			if limit is None or count + shard_count <= limit:
+				for part_path, output_f in zip(shard[1], output_fs):
+					with open(part_path, newline='') as part_f:
+						shutil.copyfileobj(part_f, output_f)
+				count += shard_count
+			elif count < limit:
+				with open(shard[1][0], newline='') as part_f:
+					rows = list(itertools.islice(part_f, limit - count))
+				output_fs[0].writelines(rows)
+				if test_day_path is not None:
+					last_offset = int(rows[-1][:rows[-1].index(',')])
+					with open(shard[1][1], newline='') as part_f:
+						output_fs[1].writelines(_rows_up_to(part_f, last_offset))
+				count = limit
+	finally:
+		for output_f in output_fs:
+			output_f.close()
+	for shard in shards:
+		for part_path in shard[1] + [shard[1][0] + '.ckpt']:
+			if os.path.exists(part_path):
+				os.remove(part_path)
+	return count
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='convert an fmt4 file to csv')
+	parser.add_argument('input', nargs='?', default='reed20180705.fmt4')
+	parser.add_argument('output', nargs='?', default='reed20180705_2.csv')
+	parser.add_argument('--limit', type=int, default=30000, help='rows to convert, 0 for all')
+	parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+	parser.add_argument('--test-days', help='write test days to this csv, one row per segment, instead of a JSON column')
+	parser.add_argument('--where', action='append',
+		help='filter clause, name=low:high or name=a,b (see fmt4_filter.CLAUSES), repeatable; '
+			'default: born 2008 or later with lactation record and lactation types')
+	parser.add_argument('--no-filter', action='store_true', help='convert every record')
+	parser.add_argument('--columns', help='comma separated fmt4_layout header fields to write')
+	parser.add_argument('--resume', action='store_true', help='continue an interrupted conversion from its checkpoint')
+	parser.add_argument('--checkpoint-every', type=int, default=100000, help='rows between checkpoints, 0 for none')
+	parser.add_argument('--stats', help='append JSON-lines throughput counters to this file')
+	parser.add_argument('--stats-every', type=float, default=10.0, help='seconds between two stats lines')
+	parser.add_argument('--sample', type=int, help='write a uniform random sample of this many rows instead of the first --limit')
+	parser.add_argument('--stratify', help='comma separated filter clause names (e.g. breed,state,birth_year), '
+		'--sample rows are drawn per stratum')
+	parser.add_argument('--seed', type=int, default=0, help='random seed of --sample')
+	args = parser.parse_args()
+	columns = args.columns.split(',') if args.columns else default_columns
+	if args.no_filter:
+		record_filter = None
+	elif args.where:
+		record_filter = Fmt4Filter.parse(args.where)
+	else:
+		record_filter = default_filter
+	convert(args.input, args.output, args.limit or None, args.workers, args.test_days, record_filter, columns,
+		args.resume, args.checkpoint_every, args.stats, args.stats_every, args.sample,
+		args.stratify.split(',') if args.stratify else (), args.seed)
@@ -0,0 +1,130 @@
+'''
+Batch decoding of fmt4 records into typed NumPy columns.
+
+The fixed-width ASCII fields of thousands of records are gathered into one
+(records x bytes) uint8 block straight from the memory-mapped file and
+decoded a whole column at a time:
+	int: digits -> int32, MISSING when the field is blank or not all digits
+	date: YYYYMMDD -> int32 days since 1970-01-01, MISSING_DATE when invalid
+	code: single character -> uint8 (the raw byte)
+	str: multi-character code -> fixed width bytes (S<width>)
+Test day segments are decoded into flat arrays, seg_index[k]:seg_index[k+1]
+being the segments of the k-th record.
+'''
+
+import numpy as np
+
+from fmt4_layout import header_projection, segment_projection
+from fmt4_reader import SEGMENT_OFFSET, SEGMENT_SIZE, open_fmt4
+
+
+def gather(data, starts, width):
+	'''
+		Description:
+			copy width bytes from every start offset into a (len(starts), width) block
+		Input:
+			data: uint8 array over the whole file
+			starts: int64 array of byte offsets
+	'''
+	return data[starts[:, None] + np.arange(width)]
+
+
+def segment_starts(offsets, seg_counts):
+	'''
+		Description:
+			byte offsets of every test day segment, in record order
+		Output:
+			(starts, seg_index) where seg_index is the CSR index of segments per record
+	'''
+	seg_index = np.zeros(len(seg_counts) + 1, dtype=np.int64)
+	np.cumsum(seg_counts, out=seg_index[1:])
+	first = np.repeat(offsets + SEGMENT_OFFSET - seg_index[:-1] * SEGMENT_SIZE, seg_counts)
+	return first + np.arange(seg_index[-1]) * SEGMENT_SIZE, seg_index
+
+
+def decode_batch(data, offsets, seg_counts, projection=header_projection(), seg_projection=segment_projection()):
+	'''
+		Description:
+			decode a batch of records
+		Input:
+			data: uint8 array over the whole file
+			offsets: record start offsets
+			seg_counts: number of test day segments per record
+			projection, seg_projection: fmt4_layout projections of the header
+				and segment columns to decode, None to skip
+		Output:
+			(columns, seg_columns, seg_index)
+	'''
+	offsets = np.asarray(offsets, dtype=np.int64)
+	seg_counts = np.asarray(seg_counts, dtype=np.int64)
+	columns = {}
+	if projection is not None:
+		columns = projection.decode_at(data, offsets)
+	starts, seg_index = segment_starts(offsets, seg_counts)
+	seg_columns = {}
+	if seg_projection is not None:
+		seg_columns = seg_projection.decode_at(data, starts)
+	return columns, seg_columns, seg_index
+
+
+def record_batches(reader, batch_size=10000, start=0, end=None, predicate=None):
+	'''
+		Description:
+			yield (data, offsets, seg_counts, base) for batches of up to batch_size
+			records accepted by predicate (see Fmt4Reader.records), data being
+			the uint8 array the offsets point into and base + offsets the
+			positions of the records in the file
+	'''
+	data_of = None
+	data = None
+	for buf, base, offsets, seg_counts in reader.batches(batch_size, start, end, predicate):
+		if buf is not data_of:
+			data_of = buf
+			data = np.frombuffer(buf, dtype=np.uint8)
+		yield data, np.array(offsets, dtype=np.int64), np.array(seg_counts, dtype=np.int64), base
+
+
+def decode_file(path, batch_size=10000, predicate=None):
+	'''
+		Description:
+			yield decode_batch results for the whole file, which may be compressed
+	'''
+	with open_fmt4(path) as reader:
+		for data, offsets, seg_counts, base in record_batches(reader, batch_size, predicate=predicate):
+			yield decode_batch(data, offsets, seg_counts)
+
+
+def iter_lactations(path, fields=None, seg_fields=None, batch_size=None, predicate=None, read_size=10000, **reader_kwargs):
+	'''
+		Description:
+			lazily decode the lactation records of an fmt4 file (which may be
+			gzip/bz2/xz compressed), the file stays open only while the
+			generator runs so callers can stop at any point
+		Input:
+			fields: fmt4_layout header field names, None for all
+			seg_fields: segment field names, None for all, [] to skip test days
+			batch_size: None yields one dict per lactation with python values
+				and 'test_days' as a dict of arrays; otherwise yields
+				(columns, seg_columns, seg_index) batches of up to batch_size records
+			predicate: Fmt4Filter (or any reader predicate) applied before decoding
+			read_size: records decoded at once when yielding single lactations
+			reader_kwargs: Fmt4StreamReader options (chunk_size, queue_size)
+				for compressed files
+		Output:
+			every result also carries the 'offset' of the record in the file
+	'''
+	projection = header_projection(fields)
+	seg_projection = segment_projection(seg_fields) if seg_fields != [] else None
+	with open_fmt4(path, **reader_kwargs) as reader:
+		for data, offsets, seg_counts, base in record_batches(reader, batch_size or read_size, predicate=predicate):
+			columns, seg_columns, seg_index = decode_batch(data, offsets, seg_counts, projection, seg_projection)
+			columns['offset'] = base + offsets
+			if batch_size:
+				yield columns, seg_columns, seg_index
+				continue
+			names = list(columns)
+			bounds = seg_index.tolist()
+			for k, values in enumerate(zip(*[columns[name].tolist() for name in names])):
+				lactation = dict(zip(names, values))
+				lactation['test_days'] = dict((name, seg_columns[name][bounds[k]:bounds[k+1]]) for name in seg_columns)
+				yield lactation
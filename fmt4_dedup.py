@@ -0,0 +1,194 @@
+'''
+Memory-bounded removal of repeated lactations across fmt4 extracts.
+
+Overlapping extracts carry the same lactation (same animal, calving date
+and lactation number) more than once. The key of a record is packed into
+one uint64, animal id (12 digits, 40 bits) << 24 | calving day since
+1900-01-01 (17 bits) << 7 | lactation number (7 bits), and kept per breed
+code in a KeySet: a sorted uint64 array plus a smaller sorted array of
+recent keys that is merged into it in bulk, so the keys seen so far cost 8
+bytes each and every batch is checked with searchsorted. Files are read in
+the order given and the first copy of a lactation wins. Records whose key
+cannot be packed (non-numeric id, missing calving date or lactation
+number) are never treated as duplicates and are counted as unkeyed.
+'''
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from fmt4_decode import gather, record_batches
+from fmt4_layout import MISSING, MISSING_DATE, header_projection
+from fmt4_reader import open_fmt4
+from fmt4_validate import write_records
+
+ID_OFFSET = 7
+ID_WIDTH = 12
+DAY_BITS = 17
+LACTATION_BITS = 7
+# calving days are stored relative to 1900-01-01
+DAY_ORIGIN = int(np.datetime64('1900-01-01', 'D').astype(np.int64))
+
+_KEY_PROJECTION = header_projection(['animal_breed_code', 'calving_date', 'lactation_num'])
+_ID_WEIGHTS = 10 ** np.arange(ID_WIDTH - 1, -1, -1, dtype=np.int64)
+
+
+def pack_keys(data, offsets):
+	'''
+		Description:
+			lactation keys of a batch of records
+		Input:
+			data: uint8 array the record offsets point into
+			offsets: record start offsets
+		Output:
+			(breeds, keys, ok): breed codes (S2), uint64 keys, and False
+			where the key could not be packed
+	'''
+	offsets = np.asarray(offsets, dtype=np.int64)
+	columns = _KEY_PROJECTION.decode_at(data, offsets)
+	digits = gather(data, offsets + ID_OFFSET, ID_WIDTH) - np.uint8(48)
+	animal = digits.astype(np.int64) @ _ID_WEIGHTS
+	day = columns['calving_date'].astype(np.int64) - DAY_ORIGIN
+	lactation = columns['lactation_num'].astype(np.int64)
+	ok = (digits <= 9).all(axis=1)
+	ok &= (columns['calving_date'] != MISSING_DATE) & (day >= 0) & (day < 1 << DAY_BITS)
+	ok &= (lactation != MISSING) & (lactation < 1 << LACTATION_BITS)
+	keys = (animal << (DAY_BITS + LACTATION_BITS)) | (day << LACTATION_BITS) | lactation
+	keys[~ok] = 0
+	return columns['animal_breed_code'], keys.astype(np.uint64), ok
+
+
+class KeySet(object):
+	'''
+		Description:
+			set of uint64 keys held as sorted arrays: recent keys go to a
+			small sorted array merged into the main one once it holds more
+			than 1/8 of it (and at least merge_size keys)
+	'''
+	def __init__(self, merge_size=1 << 16):
+		self.merge_size = merge_size
+		self.main = np.empty(0, dtype=np.uint64)
+		self.recent = np.empty(0, dtype=np.uint64)
+
+	def __len__(self):
+		return len(self.main) + len(self.recent)
+
+	@property
+	def nbytes(self):
+		return self.main.nbytes + self.recent.nbytes
+
+	def contains(self, keys):
+		found = np.zeros(len(keys), dtype=bool)
+		for known in (self.main, self.recent):
+			if len(known):
+				at = np.minimum(np.searchsorted(known, keys), len(known) - 1)
+				found |= known[at] == keys
+		return found
+
+	def _merge(self, known, keys):
+		# both sorted: one pass of np.insert instead of a sort
+		return np.insert(known, np.searchsorted(known, keys), keys)
+
+	def add(self, keys):
+		'''
+			Description:
+				add a batch of keys
+			Output:
+				boolean mask, True for the first occurrence of every key not
+				seen before
+		'''
+		keys = np.asarray(keys, dtype=np.uint64)
+		unique, first = np.unique(keys, return_index=True)
+		new = ~self.contains(unique)
+		fresh = np.zeros(len(keys), dtype=bool)
+		fresh[first[new]] = True
+		self.recent = self._merge(self.recent, unique[new])
+		if len(self.recent) >= max(self.merge_size, len(self.main) // 8):
+			self.main = self._merge(self.main, self.recent)
+			self.recent = np.empty(0, dtype=np.uint64)
+		return fresh
+
+
+class Fmt4Dedup(object):
+	'''
+		Description:
+			first-copy-wins filter of the lactations of one or more fmt4 files,
+			one KeySet per breed code
+	'''
+	def __init__(self, merge_size=1 << 16):
+		self.merge_size = merge_size
+		self.keys = {}
+		self.files = {}
+
+	def check(self, data, offsets, source=None):
+		'''
+			Description:
+				boolean mask of the records of a batch to keep, counted under source
+		'''
+		breeds, keys, ok = pack_keys(data, offsets)
+		keep = np.ones(len(keys), dtype=bool)
+		for breed in np.unique(breeds[ok]).tolist():
+			key_set = self.keys.get(breed)
+			if key_set is None:
+				key_set = self.keys[breed] = KeySet(self.merge_size)
+			rows = np.flatnonzero(ok & (breeds == breed))
+			keep[rows] = key_set.add(keys[rows])
+		counts = self.files.setdefault(source, {'records': 0, 'duplicates': 0, 'unkeyed': 0})
+		counts['records'] += len(keys)
+		counts['duplicates'] += int(len(keys) - keep.sum())
+		counts['unkeyed'] += int(len(keys) - ok.sum())
+		return keep
+
+	def report(self):
+		return {
+			'files': dict((str(source), dict(counts)) for source, counts in self.files.items()),
+			'records': sum(counts['records'] for counts in self.files.values()),
+			'duplicates': sum(counts['duplicates'] for counts in self.files.values()),
+			'keys': sum(len(key_set) for key_set in self.keys.values()),
+			'key_bytes': sum(key_set.nbytes for key_set in self.keys.values()),
+		}
+
+
+def dedup_files(paths, out_path=None, duplicates_path=None, predicate=None, batch_size=100000, merge_size=1 << 16):
+	'''
+		Description:
+			drop the repeated lactations of fmt4 files (which may be compressed),
+			read in the given order
+		Input:
+			out_path: fmt4 file receiving the first copy of every lactation
+			duplicates_path: fmt4 file receiving the dropped copies
+			predicate: Fmt4Filter (or any reader predicate) applied before deduplicating
+		Output:
+			Fmt4Dedup holding the counters
+	'''
+	dedup = Fmt4Dedup(merge_size)
+	out_f = open(out_path, 'wb') if out_path else None
+	duplicates_f = open(duplicates_path, 'wb') if duplicates_path else None
+	try:
+		for path in paths:
+			with open_fmt4(path) as reader:
+				for data, offsets, seg_counts, base in record_batches(reader, batch_size, predicate=predicate):
+					keep = dedup.check(data, offsets, path)
+					if out_f is not None:
+						write_records(out_f, data, offsets[keep], seg_counts[keep])
+					if duplicates_f is not None:
+						write_records(duplicates_f, data, offsets[~keep], seg_counts[~keep])
+	finally:
+		for f in (out_f, duplicates_f):
+			if f is not None:
+				f.close()
+	return dedup
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='drop lactations repeated across fmt4 files, the first copy wins')
+	parser.add_argument('inputs', nargs='+')
+	parser.add_argument('--output', help='write the deduplicated records to this fmt4 file')
+	parser.add_argument('--duplicates', help='write the dropped records to this fmt4 file')
+	parser.add_argument('--batch-size', type=int, default=100000, help='records checked at once')
+	args = parser.parse_args()
+	dedup = dedup_files(args.inputs, args.output, args.duplicates, batch_size=args.batch_size)
+	json.dump(dedup.report(), sys.stdout, indent=1)
+	print()
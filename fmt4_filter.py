@@ -0,0 +1,104 @@
+'''
+Record filters evaluated on raw fmt4 bytes.
+
+Every clause compares a fixed-width slice of the record against bytes
+prepared once when the filter is built, so rejected records are never
+decoded: the reader just jumps to the next record on the segment count.
+Numeric fields are zero-filled digits, so comparing the raw bytes orders
+them like the numbers they hold.
+'''
+
+from fmt4_reader import HEADER_2_OFFSET
+
+# name: (offset in record, width, kind)
+CLAUSES = {
+	'breed': (2, 2, 'set'),
+	'birth_date': (70, 8, 'range'),
+	'birth_year': (70, 4, 'range'),
+	'record_type': (87, 1, 'set'),
+	'state': (106, 2, 'set'),
+	'county': (108, 2, 'set'),
+	'lactation_type': (125, 1, 'set'),
+	'calving_date': (HEADER_2_OFFSET + 1, 8, 'range'),
+	'calving_year': (HEADER_2_OFFSET + 1, 4, 'range'),
+	'dim': (HEADER_2_OFFSET + 9, 3, 'range'),
+	'lactation_num': (HEADER_2_OFFSET + 32, 2, 'range'),
+}
+
+
+def _raw(value, width):
+	if isinstance(value, int):
+		value = str(value)
+	if isinstance(value, str):
+		value = (value.zfill(width) if value.isdigit() else value).encode('ascii')
+	if len(value) != width:
+		raise ValueError('{!r} does not fit a {} byte field'.format(value, width))
+	return value
+
+
+class Fmt4Filter(object):
+	'''
+		Description:
+			conjunction of clauses over raw record bytes
+		Input:
+			keyword arguments named after CLAUSES,
+			range clauses take (low, high) with either end None for open,
+			set clauses take an iterable of accepted values,
+			values are ints, str or bytes and are zero-filled to the field width
+	'''
+	def __init__(self, **clauses):
+		self.clauses = []
+		for name, value in clauses.items():
+			if name not in CLAUSES:
+				raise ValueError('unknown filter clause {!r}'.format(name))
+			offset, width, kind = CLAUSES[name]
+			if kind == 'set':
+				value = frozenset(_raw(v, width) for v in value)
+			else:
+				low, high = value
+				value = (None if low is None else _raw(low, width), None if high is None else _raw(high, width))
+			self.clauses.append((name, offset, offset + width, kind, value))
+
+	@classmethod
+	def parse(cls, specs):
+		'''
+			Description:
+				build a filter from command line specs,
+				'name=low:high' for ranges (either end may be empty),
+				'name=a,b,c' for sets
+		'''
+		clauses = {}
+		for spec in specs:
+			name, _, text = spec.partition('=')
+			if name not in CLAUSES:
+				raise ValueError('unknown filter clause {!r}'.format(name))
+			if CLAUSES[name][2] == 'set':
+				clauses[name] = text.split(',')
+			else:
+				low, _, high = text.partition(':')
+				clauses[name] = (low or None, high or None)
+		return cls(**clauses)
+
+	def reason(self, buf, pos):
+		'''
+			Description:
+				name of the first clause rejecting the record at buf[pos:], None if accepted
+			Input:
+				buf: bytes-like object whose slices are bytes (mmap, bytes)
+		'''
+		for name, a, b, kind, value in self.clauses:
+			raw = buf[pos+a:pos+b]
+			if kind == 'set':
+				if raw not in value:
+					return name
+			else:
+				low, high = value
+				if (low is not None and raw < low) or (high is not None and raw > high):
+					return name
+		return None
+
+	def __call__(self, buf, pos):
+		return self.reason(buf, pos) is None
+
+	def __repr__(self):
+		return 'Fmt4Filter({})'.format(', '.join(name for name, a, b, kind, value in self.clauses))
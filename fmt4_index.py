@@ -0,0 +1,200 @@
+'''
+Sidecar record index for random access into fmt4 files.
+
+build_index makes one pass over the file and writes <file>.idx.npy, a sorted
+structured array mapping animal id, breed, herd and calving date to the byte
+offset and length of each record, plus one secondary index per other lookup
+(<file>.idx.herd.npy and <file>.idx.calving.npy): a (2, records) int64
+array of the sorted lookup keys and the index rows they belong to. Fmt4Index
+loads them memory-mapped, answers every lookup with searchsorted and seeks
+straight to the matching records.
+'''
+
+import argparse
+import os
+
+import numpy as np
+
+from fmt4_decode import decode_batch, record_batches
+from fmt4_layout import header_projection
+from fmt4_reader import Fmt4Reader, SEGMENT_OFFSET, SEGMENT_SIZE
+
+INDEX_DTYPE = np.dtype([
+	('animal_id_number', 'S12'),
+	('animal_breed_code', 'S2'),
+	('calving_date', np.int32),
+	('herd_state_code', np.int16),
+	('herd_county_code', np.int16),
+	('cow_ctrl_number', np.int32),
+	('offset', np.int64),
+	('length', np.int32),
+])
+
+INDEX_ORDER = ['animal_id_number', 'animal_breed_code', 'calving_date']
+
+_INDEX_PROJECTION = header_projection(['animal_id_number', 'animal_breed_code', 'calving_date',
+	'herd_state_code', 'herd_county_code', 'cow_ctrl_number'])
+
+
+SECONDARY_INDEXES = ('herd', 'calving')
+
+# herd key digits: (state + 1) * 10**9 + (county + 1) * 10**6 + cow_ctrl + 1,
+# MISSING (-1) codes becoming 0
+_COUNTY_SCALE = 10 ** 6
+_STATE_SCALE = 1000 * _COUNTY_SCALE
+
+
+def index_path(path):
+	return path + '.idx.npy'
+
+
+def secondary_path(path, name):
+	return '{}.idx.{}.npy'.format(path, name)
+
+
+def herd_keys(state, county, cow_ctrl):
+	'''
+		Description:
+			int64 keys ordering herds by state, county then cow control number
+	'''
+	state = np.asarray(state, dtype=np.int64)
+	county = np.asarray(county, dtype=np.int64)
+	cow_ctrl = np.asarray(cow_ctrl, dtype=np.int64)
+	return (state + 1) * _STATE_SCALE + (county + 1) * _COUNTY_SCALE + cow_ctrl + 1
+
+
+def _save(path, array):
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as f:
+		np.save(f, array)
+	os.replace(tmp_path, path)
+
+
+def _secondary(keys):
+	order = np.argsort(keys, kind='stable')
+	return np.stack([keys[order], order]).astype(np.int64)
+
+
+def build_index(path, batch_size=100000):
+	'''
+		Description:
+			index every record of the fmt4 file at path
+		Output:
+			path of the sidecar index
+	'''
+	parts = []
+	with Fmt4Reader(path) as reader:
+		for data, offsets, seg_counts, base in record_batches(reader, batch_size):
+			columns = decode_batch(data, offsets, seg_counts, _INDEX_PROJECTION, None)[0]
+			part = np.empty(len(offsets), dtype=INDEX_DTYPE)
+			for name in columns:
+				part[name] = columns[name]
+			part['offset'] = offsets
+			part['length'] = SEGMENT_OFFSET + SEGMENT_SIZE * seg_counts
+			parts.append(part)
+	index = np.concatenate(parts) if parts else np.empty(0, dtype=INDEX_DTYPE)
+	index.sort(order=INDEX_ORDER)
+	_save(secondary_path(path, 'herd'), _secondary(herd_keys(index['herd_state_code'], index['herd_county_code'],
+		index['cow_ctrl_number'])))
+	_save(secondary_path(path, 'calving'), _secondary(index['calving_date'].astype(np.int64)))
+	# written last, its mtime vouches for the secondary indexes
+	_save(index_path(path), index)
+	return index_path(path)
+
+
+class Fmt4Index(object):
+	'''
+		Description:
+			point lookups into an fmt4 file through its sidecar indexes,
+			they are (re)built when one is missing or older than the file
+	'''
+	def __init__(self, path):
+		self.path = path
+		idx_path = index_path(path)
+		paths = [idx_path] + [secondary_path(path, name) for name in SECONDARY_INDEXES]
+		if not all(os.path.exists(p) for p in paths) or min(os.path.getmtime(p) for p in paths) < os.path.getmtime(path):
+			build_index(path)
+		self.index = np.load(idx_path, mmap_mode='r')
+		self.secondary = dict((name, np.load(secondary_path(path, name), mmap_mode='r')) for name in SECONDARY_INDEXES)
+		self.reader = Fmt4Reader(path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self.reader.close()
+
+	def find_animal(self, animal_id, breed=None):
+		'''
+			Description:
+				index entries of one animal, ordered by calving date
+		'''
+		if isinstance(animal_id, str):
+			animal_id = animal_id.encode('ascii')
+		ids = self.index['animal_id_number']
+		lo = np.searchsorted(ids, animal_id, 'left')
+		hi = np.searchsorted(ids, animal_id, 'right')
+		entries = self.index[lo:hi]
+		if breed is not None:
+			if isinstance(breed, str):
+				breed = breed.encode('ascii')
+			entries = entries[entries['animal_breed_code'] == breed]
+		return entries
+
+	def _lookup(self, name, low, high):
+		# index entries whose secondary key is in [low, high)
+		keys, rows = self.secondary[name]
+		lo = np.searchsorted(keys, low, 'left')
+		hi = np.searchsorted(keys, high, 'left')
+		return self.index[np.asarray(rows[lo:hi])]
+
+	def find_herd(self, state, county=None, cow_ctrl=None):
+		'''
+			Description:
+				index entries of a state, county or herd, ordered by county and
+				cow control number
+		'''
+		if county is None:
+			low = herd_keys(state, -1, -1)
+			entries = self._lookup('herd', low, low + _STATE_SCALE)
+			if cow_ctrl is not None:
+				entries = entries[entries['cow_ctrl_number'] == cow_ctrl]
+			return entries
+		low = herd_keys(state, county, -1)
+		if cow_ctrl is None:
+			return self._lookup('herd', low, low + _COUNTY_SCALE)
+		key = herd_keys(state, county, cow_ctrl)
+		return self._lookup('herd', key, key + 1)
+
+	def find_calving(self, first_day, last_day):
+		'''
+			Description:
+				index entries calving between first_day and last_day inclusive,
+				days since 1970-01-01 as decoded by fmt4_decode, ordered by calving date
+		'''
+		return self._lookup('calving', first_day, last_day + 1)
+
+	def records(self, entries):
+		'''
+			Description:
+				yield (offset, record) memoryviews for index entries
+		'''
+		buf = self.reader.buf
+		for offset, length in zip(entries['offset'].tolist(), entries['length'].tolist()):
+			yield offset, buf[offset:offset+length]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='build the sidecar index of an fmt4 file')
+	parser.add_argument('input')
+	parser.add_argument('--animal', help='print the records of this animal id')
+	args = parser.parse_args()
+	if args.animal is None:
+		print(build_index(args.input))
+	else:
+		with Fmt4Index(args.input) as index:
+			for offset, rec in index.records(index.find_animal(args.animal.zfill(12))):
+				print(offset, str(rec, 'ascii'))
@@ -0,0 +1,150 @@
+'''
+Incremental conversion of a directory of fmt4 extracts.
+
+Every fmt4 file (compressed ones included) found in the input directory is
+converted with fmt4_csv.convert into the output directory by a pool of
+worker processes. manifest.json in the output directory records the size,
+mtime and sha256 of each converted input; files whose size and mtime are
+unchanged are skipped, and so are files that were only touched, whose
+content hash still matches. A checkpoint left by an interrupted conversion
+is resumed when it belongs to the current content of its input and
+discarded otherwise. Inputs that would share an output (x.fmt4 and
+x.fmt4.gz) are refused before anything is converted.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from fmt4_csv import convert, default_filter, input_stamp
+
+MANIFEST_NAME = 'manifest.json'
+FMT4_SUFFIXES = ('.fmt4', '.fmt4.gz', '.fmt4.bz2', '.fmt4.xz')
+
+
+def file_hash(path, block_size=1 << 20):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def load_manifest(out_dir):
+	path = os.path.join(out_dir, MANIFEST_NAME)
+	if not os.path.exists(path):
+		return {}
+	with open(path) as f:
+		return json.load(f)
+
+
+def save_manifest(out_dir, manifest):
+	path = os.path.join(out_dir, MANIFEST_NAME)
+	with open(path + '.tmp', 'w') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	os.replace(path + '.tmp', path)
+
+
+def output_paths(out_dir, file_name, test_days):
+	stem = file_name.split('.fmt4')[0]
+	if test_days:
+		return os.path.join(out_dir, stem + '_lactations.csv'), os.path.join(out_dir, stem + '_test_days.csv')
+	return os.path.join(out_dir, stem + '.csv'), None
+
+
+def fmt4_files(in_dir):
+	return [file_name for file_name in sorted(os.listdir(in_dir))
+		if file_name.endswith(FMT4_SUFFIXES) and os.path.isfile(os.path.join(in_dir, file_name))]
+
+
+def check_collisions(in_dir, test_days):
+	'''
+		Description:
+			raise ValueError when two fmt4 files of in_dir (e.g. x.fmt4 and
+			x.fmt4.gz) would be converted into the same output
+	'''
+	owners = {}
+	for file_name in fmt4_files(in_dir):
+		out_path = output_paths('', file_name, test_days)[0]
+		if out_path in owners:
+			raise ValueError('{} and {} would both be converted to {}'.format(owners[out_path], file_name, out_path))
+		owners[out_path] = file_name
+
+
+def changed_files(in_dir, manifest):
+	'''
+		Description:
+			fmt4 files of in_dir that are new or whose content changed since
+			they were recorded in manifest, entries whose content did not
+			change get their mtime refreshed in place
+		Output:
+			list of (file name, stat entry for the manifest)
+	'''
+	todo = []
+	for file_name in fmt4_files(in_dir):
+		path = os.path.join(in_dir, file_name)
+		st = os.stat(path)
+		entry = {'size': st.st_size, 'mtime': st.st_mtime}
+		known = manifest.get(file_name)
+		if known is not None and known['size'] == entry['size'] and known['mtime'] == entry['mtime']:
+			continue
+		entry['sha256'] = file_hash(path)
+		if known is not None and known.get('sha256') == entry['sha256']:
+			known['mtime'] = entry['mtime']
+			continue
+		todo.append((file_name, entry))
+	return todo
+
+
+def _ingest_file(args):
+	in_path, out_path, test_day_path, record_filter = args
+	checkpoint_path = out_path + '.ckpt'
+	if os.path.exists(checkpoint_path):
+		with open(checkpoint_path) as f:
+			state = json.load(f)
+		if any(state.get(key) != value for key, value in input_stamp(in_path).items()):
+			# left by an interrupted run over an earlier version of the file, start over
+			os.remove(checkpoint_path)
+	return convert(in_path, out_path, None, 1, test_day_path, record_filter, resume=True)
+
+
+def ingest(in_dir, out_dir, workers=1, test_days=False, record_filter=default_filter):
+	'''
+		Description:
+			convert the new or changed fmt4 files of in_dir into out_dir
+		Input:
+			workers: number of files converted in parallel
+			test_days: write lactation and test day tables instead of one csv per file
+		Output:
+			{file name: rows written} for the files converted by this run
+	'''
+	check_collisions(in_dir, test_days)
+	if not os.path.isdir(out_dir):
+		os.makedirs(out_dir)
+	manifest = load_manifest(out_dir)
+	todo = changed_files(in_dir, manifest)
+	jobs = [(os.path.join(in_dir, file_name),) + output_paths(out_dir, file_name, test_days) + (record_filter,)
+		for file_name, entry in todo]
+	converted = {}
+	with ProcessPoolExecutor(max(1, workers)) as pool:
+		for (file_name, entry), count in zip(todo, pool.map(_ingest_file, jobs)):
+			entry['rows'] = count
+			manifest[file_name] = entry
+			converted[file_name] = count
+			# recorded as soon as each file is done so an interrupted run keeps its progress
+			save_manifest(out_dir, manifest)
+	save_manifest(out_dir, manifest)
+	return converted
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='convert new or changed fmt4 files of a directory to csv')
+	parser.add_argument('in_dir')
+	parser.add_argument('out_dir')
+	parser.add_argument('--workers', type=int, default=os.cpu_count(), help='files converted in parallel')
+	parser.add_argument('--test-days', action='store_true', help='write lactation and test day tables')
+	args = parser.parse_args()
+	for file_name, count in sorted(ingest(args.in_dir, args.out_dir, args.workers, args.test_days).items()):
+		print(file_name, count)
@@ -0,0 +1,222 @@
+'''
+Declarative fmt4 record layout.
+
+Each block (header 1, header 2, test day segment) is a table of
+(name, offset, width, kind) rows; kinds are described in fmt4_decode.
+A Projection compiles a subset of the columns once into
+	- a struct.Struct that unpacks the raw field bytes of one record
+	- a NumPy decoder that gathers only the bytes of the requested columns
+	  of every record (decode_at) and turns them into typed columns, all
+	  digit fields being decoded by one reduceat
+so only the requested columns are ever touched.
+'''
+
+import struct
+from functools import lru_cache
+
+import numpy as np
+
+from fmt4_reader import HEADER_2_OFFSET, SEGMENT_OFFSET, SEGMENT_SIZE
+
+MISSING = -1
+MISSING_DATE = np.iinfo(np.int32).min
+
+# (name, offset in block, width, kind)
+HEADER_1_FIELDS = [
+	('animal_breed_code', 2, 2, 'str'),
+	('animal_id_number', 7, 12, 'str'),
+	('birth_date', 70, 8, 'date'),
+	('record_type', 87, 1, 'code'),
+	('multiple_birth_code', 90, 1, 'code'),
+	('herd_state_code', 106, 2, 'int'),
+	('herd_county_code', 108, 2, 'int'),
+	('cow_ctrl_number', 114, 5, 'int'),
+	('date_cow_left', 119, 6, 'int'),
+	('lactation_type_code', 125, 1, 'code'),
+]
+
+HEADER_2_FIELDS = [
+	('lactation_verify_code', 0, 1, 'code'),
+	('calving_date', 1, 8, 'date'),
+	('DIM', 9, 3, 'int'),
+	('days_dry_prior', 12, 3, 'int'),
+	('actual_milk_yield', 20, 4, 'int'),
+	('actual_fat_yield', 24, 4, 'int'),
+	('actual_protein_yield', 28, 4, 'int'),
+	('lactation_num', 32, 2, 'int'),
+	('primary_dest_group', 34, 1, 'code'),
+	('date_breeding_conception', 35, 8, 'date'),
+	('body_weight_start', 43, 3, 'int'),
+	('weight_report_code', 46, 1, 'code'),
+	('lactation_init_code', 47, 1, 'code'),
+	('milking_dry_status', 48, 1, 'code'),
+	('type_of_test_plan_code', 49, 2, 'int'),
+	('type_lactation_sc_score', 51, 1, 'code'),
+	('true_protein_code', 58, 1, 'code'),
+	('test_method_code', 59, 1, 'code'),
+	('qc_status', 60, 1, 'code'),
+	('lactation_std_milk_yield', 61, 5, 'int'),
+	('lactation_std_fat_yield', 66, 4, 'int'),
+	('lactation_std_protein_yield', 70, 4, 'int'),
+	('num_tests_components_taken', 107, 2, 'int'),
+	('DCR_for_yield', 109, 3, 'int'),
+	('DCR_for_somatic_cell', 112, 3, 'int'),
+	('preg_confirm_code', 115, 1, 'code'),
+	('num_progeny_born', 116, 1, 'code'),
+	('second_term_code', 117, 1, 'code'),
+	('num_seg_test_days', 122, 2, 'int'),
+]
+
+SEGMENT_FIELDS = [
+	('dim_test', 0, 3, 'int'),
+	('supervision_code', 3, 1, 'code'),
+	('last_test_status_code', 4, 1, 'code'),
+	('milking_freq', 5, 1, 'code'),
+	('num_milking_weighted', 6, 1, 'code'),
+	('num_milking_sample', 7, 1, 'code'),
+	('num_MRD', 8, 2, 'int'),
+	('percent_milk_shipped', 10, 3, 'int'),
+	('actual_milk_yield', 13, 4, 'int'),
+	('actual_fat_percent', 17, 2, 'int'),
+	('actual_protein_percent', 19, 2, 'int'),
+	('actual_SCS', 21, 2, 'int'),
+]
+
+# header fields with offsets relative to the start of the record
+HEADER_FIELDS = HEADER_1_FIELDS + [(name, HEADER_2_OFFSET + offset, width, kind)
+	for name, offset, width, kind in HEADER_2_FIELDS]
+
+HEADER_NAMES = [field[0] for field in HEADER_FIELDS]
+SEGMENT_NAMES = [field[0] for field in SEGMENT_FIELDS]
+
+
+def field_dtype(kind, width):
+	if kind == 'code':
+		return np.dtype(np.uint8)
+	if kind == 'str':
+		return np.dtype('S{}'.format(width))
+	return np.dtype(np.int32)
+
+
+def decode_dates(ymd):
+	'''
+		Description:
+			YYYYMMDD ints -> int32 days since 1970-01-01, MISSING_DATE when invalid
+	'''
+	year = ymd // 10000
+	month = ymd // 100 % 100
+	day = ymd % 100
+	ok = (ymd != MISSING) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+	months = ((year - 1970) * 12 + month - 1).astype('M8[M]')
+	days = months.astype('M8[D]') + (day - 1)
+	# days past the end of the month roll over into the next one
+	ok &= days.astype('M8[M]') == months
+	days = days.astype(np.int64).astype(np.int32)
+	days[~ok] = MISSING_DATE
+	return days
+
+
+class Projection(object):
+	'''
+		Description:
+			a subset of the fields of one layout, compiled for decoding
+		Input:
+			layout: list of (name, offset, width, kind)
+			names: requested field names in output order, None for all
+			block_size: bytes per record of the blocks the layout describes
+	'''
+	def __init__(self, layout, names=None, block_size=None):
+		by_name = dict((field[0], field) for field in layout)
+		if names is None:
+			names = [field[0] for field in layout]
+		unknown = [name for name in names if name not in by_name]
+		if unknown:
+			raise ValueError('unknown fmt4 fields {}'.format(unknown))
+		self.fields = [by_name[name] for name in names]
+		self.names = list(names)
+		self.block_size = block_size
+
+		# struct over the fields in offset order, then put back in requested order
+		in_offset_order = sorted(range(len(self.fields)), key=lambda k: self.fields[k][1])
+		fmt = ['=']
+		pos = 0
+		for k in in_offset_order:
+			name, offset, width, kind = self.fields[k]
+			if offset < pos:
+				raise ValueError('overlapping fmt4 fields in projection: {}'.format(name))
+			if offset > pos:
+				fmt.append('{}x'.format(offset - pos))
+			fmt.append('{}s'.format(width))
+			pos = offset + width
+		self.struct = struct.Struct(''.join(fmt))
+		self._order = [in_offset_order.index(k) for k in range(len(self.fields))]
+
+		# the byte columns of the fields in offset order, decoding works on these only
+		byte_cols = sorted(col for name, offset, width, kind in self.fields for col in range(offset, offset + width))
+		self._byte_cols = np.array(byte_cols, dtype=np.intp)
+		at = dict((col, k) for k, col in enumerate(byte_cols))
+
+		# every digit of every int/date field gathered in one go
+		digit_fields = [field for field in self.fields if field[3] in ('int', 'date')]
+		self._digit_names = [field[0] for field in digit_fields]
+		self._date_names = set(field[0] for field in digit_fields if field[3] == 'date')
+		self._digit_cols = np.array([at[col] for name, offset, width, kind in digit_fields
+			for col in range(offset, offset + width)], dtype=np.intp)
+		self._digit_weights = np.array([10 ** p for name, offset, width, kind in digit_fields
+			for p in range(width - 1, -1, -1)], dtype=np.int32)
+		self._digit_starts = np.cumsum([0] + [width for name, offset, width, kind in digit_fields[:-1]]).astype(np.intp)
+		self._codes = [(name, at[offset]) for name, offset, width, kind in self.fields if kind == 'code']
+		# fields do not overlap, so the bytes of a str field stay contiguous
+		self._strs = [(name, at[offset], width) for name, offset, width, kind in self.fields if kind == 'str']
+
+	def unpack_str(self, buf, pos=0):
+		values = self.struct.unpack_from(buf, pos)
+		return [values[k].decode('ascii') for k in self._order]
+
+	def decode_at(self, data, starts):
+		'''
+			Description:
+				decode the blocks starting at starts, gathering only the bytes
+				of the projected fields
+			Input:
+				data: uint8 array over the whole file
+				starts: int64 array of block offsets
+		'''
+		# the _byte_cols of every block
+		block = data[starts[:, None] + self._byte_cols]
+		columns = {}
+		if self._digit_names:
+			digits = block[:, self._digit_cols] - np.uint8(48)
+			bad = np.logical_or.reduceat(digits > 9, self._digit_starts, axis=1)
+			values = np.add.reduceat(digits * self._digit_weights, self._digit_starts, axis=1, dtype=np.int32)
+			values[bad] = MISSING
+			for k, name in enumerate(self._digit_names):
+				column = np.ascontiguousarray(values[:, k])
+				columns[name] = decode_dates(column) if name in self._date_names else column
+		for name, offset in self._codes:
+			columns[name] = block[:, offset].copy()
+		for name, offset, width in self._strs:
+			columns[name] = np.ascontiguousarray(block[:, offset:offset+width]).view('S{}'.format(width)).ravel()
+		return dict((name, columns[name]) for name in self.names)
+
+
+@lru_cache(maxsize=None)
+def _header_projection(names):
+	return Projection(HEADER_FIELDS, names, SEGMENT_OFFSET)
+
+
+@lru_cache(maxsize=None)
+def _segment_projection(names):
+	return Projection(SEGMENT_FIELDS, names, SEGMENT_SIZE)
+
+
+def header_projection(names=None):
+	'''
+		Description:
+			compiled projection over header 1 + header 2, offsets relative to the record start
+	'''
+	return _header_projection(None if names is None else tuple(names))
+
+
+def segment_projection(names=None):
+	return _segment_projection(None if names is None else tuple(names))
@@ -0,0 +1,278 @@
+'''
+Hive-style partitioned csv output of fmt4 files.
+
+Rows are written under out_dir/<key>=<value>/.../ directories, by default
+herd_state_code=05/herd_county_code=12/birth_year=2009/, the partition
+values being taken from the raw header bytes (blank or odd values go to
+__HIVE_DEFAULT_PARTITION__). Rows are buffered per partition and flushed
+in batches through an LRU pool of at most max_open file handles, so
+thousands of partitions never mean thousands of open files. Each worker
+writes its own part<k>.csv in every partition it touches (plus
+part<k>_test_days.csv with test days), and manifest.json lists the files
+and row count of every partition.
+'''
+
+import argparse
+import csv
+import json
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from fmt4_csv import csv_header, default_columns, default_filter, json_row, test_day_header
+from fmt4_filter import Fmt4Filter
+from fmt4_layout import HEADER_FIELDS, header_projection, segment_projection
+from fmt4_reader import HEADER_2_OFFSET, Fmt4Reader, open_fmt4, segments
+
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+# partition key: (offset, width) of its raw bytes in the record
+PARTITION_KEYS = dict((name, (offset, width)) for name, offset, width, kind in HEADER_FIELDS if kind in ('str', 'int', 'code'))
+PARTITION_KEYS['birth_year'] = (70, 4)
+PARTITION_KEYS['calving_year'] = (HEADER_2_OFFSET + 1, 4)
+DEFAULT_KEYS = ('herd_state_code', 'herd_county_code', 'birth_year')
+
+_UNSAFE = re.compile(r'[^0-9A-Za-z_-]')
+
+
+def partition_dir(keys, values):
+	'''
+		Description:
+			relative directory of a partition, values being the raw key bytes
+	'''
+	parts = []
+	for name, value in zip(keys, values):
+		text = value.decode('ascii', 'replace').strip()
+		if not text or _UNSAFE.search(text):
+			text = DEFAULT_PARTITION
+		parts.append('{}={}'.format(name, text))
+	return '/'.join(parts)
+
+
+class HandlePool(object):
+	'''
+		Description:
+			least recently used pool of at most max_open csv files opened for
+			appending, a file is created with its header row the first time
+	'''
+	def __init__(self, max_open=256):
+		self.max_open = max_open
+		self._open = OrderedDict()
+		self._created = set()
+
+	def writer(self, path, header):
+		entry = self._open.pop(path, None)
+		if entry is None:
+			if len(self._open) >= self.max_open:
+				oldest_path, (oldest_f, oldest_w) = self._open.popitem(last=False)
+				oldest_f.close()
+			if path in self._created:
+				output_f = open(path, 'a', newline='')
+				w = csv.writer(output_f)
+			else:
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+				output_f = open(path, 'w', newline='')
+				w = csv.writer(output_f)
+				w.writerow(header)
+				self._created.add(path)
+			entry = (output_f, w)
+		self._open[path] = entry
+		return entry[1]
+
+	def close(self):
+		while self._open:
+			path, (output_f, w) = self._open.popitem()
+			output_f.close()
+
+
+class PartitionedWriter(object):
+	'''
+		Description:
+			buffers rows per partition and writes them through a HandlePool
+		Input:
+			out_dir: root of the partition directories
+			part: name of this writer's files within each partition
+			headers: header row of the lactation file, and of the test day file if any
+			buffer_rows: rows held before flushing every partition
+	'''
+	def __init__(self, out_dir, part, headers, max_open=256, buffer_rows=100000):
+		self.out_dir = out_dir
+		self.part = part
+		self.headers = headers
+		self.pool = HandlePool(max_open)
+		self.buffer_rows = buffer_rows
+		self.counts = {}
+		self._rows = {}
+		self._buffered = 0
+
+	def write(self, partition, row, test_day_rows=None):
+		rows = self._rows.get(partition)
+		if rows is None:
+			rows = self._rows[partition] = ([], [])
+		rows[0].append(row)
+		self._buffered += 1
+		if test_day_rows:
+			rows[1].extend(test_day_rows)
+			self._buffered += len(test_day_rows)
+		self.counts[partition] = self.counts.get(partition, 0) + 1
+		if self._buffered >= self.buffer_rows:
+			self.flush()
+
+	def file_names(self):
+		names = [self.part + '.csv']
+		if len(self.headers) > 1:
+			names.append(self.part + '_test_days.csv')
+		return names
+
+	def flush(self):
+		for partition in sorted(self._rows):
+			for name, header, rows in zip(self.file_names(), self.headers, self._rows[partition]):
+				if rows:
+					self.pool.writer(os.path.join(self.out_dir, partition, name), header).writerows(rows)
+		self._rows = {}
+		self._buffered = 0
+
+	def close(self):
+		self.flush()
+		self.pool.close()
+
+
+def partition_range(reader, writer, keys=DEFAULT_KEYS, start=0, end=None, record_filter=default_filter,
+		columns=default_columns, test_days=False):
+	'''
+		Description:
+			write the records of reader from start to end into writer
+		Output:
+			number of rows written
+	'''
+	slices = [PARTITION_KEYS[name] for name in keys]
+	projection = header_projection(columns)
+	seg_projection = segment_projection()
+	dirs = {}
+	count = 0
+	for offset, rec in reader.records(start, end, record_filter):
+		values = tuple(bytes(rec[pos:pos+width]) for pos, width in slices)
+		partition = dirs.get(values)
+		if partition is None:
+			partition = dirs[values] = partition_dir(keys, values)
+		if test_days:
+			writer.write(partition, [offset] + projection.unpack_str(rec),
+				[[offset, j] + seg_projection.unpack_str(seg) for j, seg in enumerate(segments(rec))])
+		else:
+			writer.write(partition, json_row(rec, projection, seg_projection))
+		count += 1
+	return count
+
+
+def _partition_shard(args):
+	in_path, out_dir, part, keys, start, end, record_filter, columns, test_days, headers, max_open = args
+	writer = PartitionedWriter(out_dir, part, headers, max_open)
+	try:
+		with open_fmt4(in_path) as reader:
+			partition_range(reader, writer, keys, start, end, record_filter, columns, test_days)
+	finally:
+		writer.close()
+	return writer.counts, writer.file_names()
+
+
+def _remove_previous(out_dir):
+	# files listed by the manifest of an earlier run, nothing else is touched
+	path = os.path.join(out_dir, MANIFEST_NAME)
+	if not os.path.exists(path):
+		return
+	with open(path) as f:
+		manifest = json.load(f)
+	for partition, entry in manifest['partitions'].items():
+		for name in entry['files']:
+			file_path = os.path.join(out_dir, partition, name)
+			if os.path.exists(file_path):
+				os.remove(file_path)
+		try:
+			os.removedirs(os.path.join(out_dir, partition))
+		except OSError:
+			# still holds other files
+			pass
+	os.remove(path)
+
+
+def convert_partitioned(in_path, out_dir, keys=DEFAULT_KEYS, workers=1, test_days=False, record_filter=default_filter,
+		columns=default_columns, max_open=256):
+	'''
+		Description:
+			convert an fmt4 file (or a gzip/bz2/xz compressed one) into
+			partitioned csv files under out_dir, replacing the output of an
+			earlier run
+		Input:
+			keys: PARTITION_KEYS names, one directory level each
+			workers: processes, each writing part<k> files for one shard of the input
+			test_days: write lactation and test day tables instead of a JSON column
+			max_open: open file handles per worker
+		Output:
+			the manifest
+	'''
+	unknown = [name for name in keys if name not in PARTITION_KEYS]
+	if unknown:
+		raise ValueError('unknown partition keys {}'.format(unknown))
+	if test_days:
+		headers = [['record_offset'] + csv_header(columns), test_day_header]
+	else:
+		headers = [csv_header(columns) + ['seg_data(JSON)']]
+	if os.path.isdir(out_dir):
+		_remove_previous(out_dir)
+	os.makedirs(out_dir, exist_ok=True)
+	with open_fmt4(in_path) as reader:
+		# compressed inputs can only be read sequentially
+		bounds = [0, None]
+		if workers > 1 and isinstance(reader, Fmt4Reader):
+			bounds = reader.shard_boundaries(workers)
+	shards = [(in_path, out_dir, 'part{}'.format(k), list(keys), bounds[k], bounds[k+1], record_filter, columns, test_days,
+		headers, max_open) for k in range(len(bounds) - 1)]
+	if len(shards) == 1:
+		results = [_partition_shard(shards[0])]
+	else:
+		with ProcessPoolExecutor(workers) as pool:
+			results = list(pool.map(_partition_shard, shards))
+	partitions = {}
+	for counts, file_names in results:
+		for partition, rows in counts.items():
+			entry = partitions.setdefault(partition, {'rows': 0, 'files': []})
+			entry['rows'] += rows
+			entry['files'].extend(file_names)
+	manifest = {
+		'input': os.path.abspath(in_path),
+		'keys': list(keys),
+		'test_days': test_days,
+		'rows': sum(entry['rows'] for entry in partitions.values()),
+		'partitions': dict(sorted(partitions.items())),
+	}
+	path = os.path.join(out_dir, MANIFEST_NAME)
+	with open(path + '.tmp', 'w') as f:
+		json.dump(manifest, f, indent=1)
+	os.replace(path + '.tmp', path)
+	return manifest
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='convert an fmt4 file to hive-style partitioned csv')
+	parser.add_argument('input')
+	parser.add_argument('out_dir')
+	parser.add_argument('--keys', default=','.join(DEFAULT_KEYS), help='comma separated partition keys, one directory level each')
+	parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+	parser.add_argument('--test-days', action='store_true', help='write lactation and test day tables per partition')
+	parser.add_argument('--where', action='append', help='filter clause, see fmt4_csv --where')
+	parser.add_argument('--no-filter', action='store_true', help='convert every record')
+	parser.add_argument('--columns', help='comma separated fmt4_layout header fields to write')
+	parser.add_argument('--max-open', type=int, default=256, help='open file handles per worker')
+	args = parser.parse_args()
+	if args.no_filter:
+		record_filter = None
+	elif args.where:
+		record_filter = Fmt4Filter.parse(args.where)
+	else:
+		record_filter = default_filter
+	columns = args.columns.split(',') if args.columns else default_columns
+	manifest = convert_partitioned(args.input, args.out_dir, args.keys.split(','), args.workers, args.test_days, record_filter,
+		columns, args.max_open)
+	print(len(manifest['partitions']), manifest['rows'])
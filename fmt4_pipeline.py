@@ -0,0 +1,162 @@
+'''
+Pipelined fmt4 to csv conversion.
+
+Three stages connected by bounded queues:
+	reader thread: cuts the input (raw or compressed) into blocks of
+		batch_size whole records and submits each block to the pool
+	decoder processes: filter the records of a block and format its csv
+		rows (fmt4_csv JSON column or lactation/test day tables) into text
+	writer thread: takes the pending results in input order and writes them
+The queue of pending blocks holds at most queue_size entries, so a slow
+writer stalls the reader instead of filling memory, while the reader's
+I/O overlaps the decoding. The output is the same as fmt4_csv.convert.
+'''
+
+import argparse
+import csv
+import io
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from fmt4_csv import csv_header, default_columns, default_filter, json_row, test_day_header
+from fmt4_filter import Fmt4Filter
+from fmt4_layout import header_projection, segment_projection
+from fmt4_reader import SEGMENT_OFFSET, SEGMENT_SIZE, Fmt4BytesReader, open_fmt4, segments
+
+
+def format_block(args):
+	'''
+		Description:
+			csv text of the records of one block accepted by record_filter
+		Input:
+			args: (block bytes, file offset of the block, record_filter, columns, test_days)
+		Output:
+			(texts, ends): the text of every output and, per output, the end
+			of each record's rows in it
+	'''
+	block, base, record_filter, columns, test_days = args
+	projection = header_projection(columns)
+	seg_projection = segment_projection()
+	outputs = [io.StringIO() for k in range(2 if test_days else 1)]
+	writers = [csv.writer(output) for output in outputs]
+	ends = [[] for output in outputs]
+	with Fmt4BytesReader(block) as reader:
+		for offset, rec in reader.records(predicate=record_filter):
+			if test_days:
+				offset += base
+				writers[0].writerow([offset] + projection.unpack_str(rec))
+				writers[1].writerows([offset, j] + seg_projection.unpack_str(seg) for j, seg in enumerate(segments(rec)))
+			else:
+				writers[0].writerow(json_row(rec, projection, seg_projection))
+			for output, output_ends in zip(outputs, ends):
+				output_ends.append(output.tell())
+	return [output.getvalue() for output in outputs], ends
+
+
+def convert(in_path, out_path, limit=None, workers=2, test_day_path=None, record_filter=default_filter,
+		columns=default_columns, batch_size=20000, queue_size=None):
+	'''
+		Description:
+			fmt4_csv.convert through the reader / decoder pool / writer pipeline
+		Input:
+			workers: decoder processes
+			batch_size: records per block
+			queue_size: blocks in flight, default 2 per worker
+		Output:
+			rows written
+	'''
+	test_days = test_day_path is not None
+	out_paths = [out_path, test_day_path] if test_days else [out_path]
+	if test_days:
+		headers = [['record_offset'] + csv_header(columns), test_day_header]
+	else:
+		headers = [csv_header(columns) + ['seg_data(JSON)']]
+	pending = queue.Queue(queue_size or 2 * workers)
+	stop = threading.Event()
+	errors = []
+	counts = [0]
+
+	def read(pool):
+		try:
+			with open_fmt4(in_path) as reader:
+				for buf, base, offsets, seg_counts in reader.batches(batch_size):
+					if stop.is_set():
+						break
+					end = offsets[-1] + SEGMENT_OFFSET + SEGMENT_SIZE * seg_counts[-1]
+					block = bytes(buf[offsets[0]:end])
+					pending.put(pool.submit(format_block, (block, base + offsets[0], record_filter, columns, test_days)))
+		except BaseException as e:
+			errors.append(e)
+			stop.set()
+		finally:
+			pending.put(None)
+
+	def write(output_fs):
+		count = 0
+		try:
+			while True:
+				future = pending.get()
+				if future is None:
+					break
+				if stop.is_set():
+					# keep draining so the reader is never left blocked
+					future.cancel()
+					continue
+				texts, ends = future.result()
+				n = len(ends[0])
+				if limit is not None and count + n >= limit:
+					n = limit - count
+					texts = [text[:output_ends[n-1]] if n else '' for text, output_ends in zip(texts, ends)]
+					stop.set()
+				for output_f, text in zip(output_fs, texts):
+					output_f.write(text)
+				count += n
+		except BaseException as e:
+			errors.append(e)
+			stop.set()
+			while pending.get() is not None:
+				pass
+		counts[0] = count
+
+	output_fs = [open(path, 'w', newline='') for path in out_paths]
+	try:
+		for output_f, labels_row in zip(output_fs, headers):
+			csv.writer(output_f).writerow(labels_row)
+		with ProcessPoolExecutor(workers) as pool:
+			reader_thread = threading.Thread(target=read, args=(pool,), name='fmt4-pipeline-reader')
+			writer_thread = threading.Thread(target=write, args=(output_fs,), name='fmt4-pipeline-writer')
+			reader_thread.start()
+			writer_thread.start()
+			reader_thread.join()
+			writer_thread.join()
+	finally:
+		for output_f in output_fs:
+			output_f.close()
+	if errors:
+		raise errors[0]
+	return counts[0]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='convert an fmt4 file to csv with pipelined reading, decoding and writing')
+	parser.add_argument('input')
+	parser.add_argument('output')
+	parser.add_argument('--limit', type=int, default=0, help='rows to convert, 0 for all')
+	parser.add_argument('--workers', type=int, default=2, help='decoder processes')
+	parser.add_argument('--test-days', help='write test days to this csv, one row per segment, instead of a JSON column')
+	parser.add_argument('--where', action='append', help='filter clause, see fmt4_csv --where')
+	parser.add_argument('--no-filter', action='store_true', help='convert every record')
+	parser.add_argument('--columns', help='comma separated fmt4_layout header fields to write')
+	parser.add_argument('--batch-size', type=int, default=20000, help='records per block')
+	parser.add_argument('--queue-size', type=int, help='blocks in flight, default 2 per worker')
+	args = parser.parse_args()
+	if args.no_filter:
+		record_filter = None
+	elif args.where:
+		record_filter = Fmt4Filter.parse(args.where)
+	else:
+		record_filter = default_filter
+	columns = args.columns.split(',') if args.columns else default_columns
+	print(convert(args.input, args.output, args.limit or None, args.workers, args.test_days, record_filter, columns,
+		args.batch_size, args.queue_size))
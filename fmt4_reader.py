@@ -0,0 +1,377 @@
+'''
+Zero-copy reader for CDCB fmt4 files.
+
+A record is header 1 (126 bytes), header 2 (124 bytes) and
+num_seg_test_days segments of 23 bytes each, where num_seg_test_days is the
+last two bytes of header 2. Records may be separated by newlines.
+The file is memory-mapped and every record is handed out as a memoryview
+into the mapping, so nothing is copied until a field is actually decoded.
+gzip/bz2/xz files cannot be mapped, Fmt4StreamReader decompresses them in a
+background thread into a bounded queue of chunks instead; open_fmt4 picks
+the reader from the magic bytes of the file.
+'''
+
+import bz2
+import gzip
+import lzma
+import mmap
+import os
+import queue
+import threading
+
+HEADER_1_SIZE = 126
+HEADER_2_SIZE = 124
+SEGMENT_SIZE = 23
+
+# offsets relative to the start of a record
+HEADER_2_OFFSET = HEADER_1_SIZE
+SEGMENT_OFFSET = HEADER_1_SIZE + HEADER_2_SIZE
+SEG_COUNT_OFFSET = HEADER_2_OFFSET + 122
+
+NEWLINE_BYTES = (10, 13)
+
+# magic bytes -> opener of compressed extracts
+COMPRESSED_MAGIC = [
+	(b'\x1f\x8b', gzip.open),
+	(b'BZh', bz2.open),
+	(b'\xfd7zXZ\x00', lzma.open),
+]
+
+
+class Fmt4FormatError(ValueError):
+	def __init__(self, path, offset, message):
+		ValueError.__init__(self, '{}: byte {}: {}'.format(path, offset, message))
+		self.path = path
+		self.offset = offset
+
+
+def segment_count(rec):
+	return (len(rec) - SEGMENT_OFFSET) // SEGMENT_SIZE
+
+
+def segments(rec):
+	for i in range(SEGMENT_OFFSET, len(rec), SEGMENT_SIZE):
+		yield rec[i:i+SEGMENT_SIZE]
+
+
+class Fmt4Reader(object):
+	'''
+		Description:
+			memory-mapped fmt4 file, iterated record by record
+		Input:
+			path: fmt4 file to read
+	'''
+	def __init__(self, path):
+		self.path = path
+		self._f = open(path, 'rb')
+		self.size = os.fstat(self._f.fileno()).st_size
+		if self.size:
+			self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			self._mm = b''
+		self.buf = memoryview(self._mm)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self.buf.release()
+		try:
+			if isinstance(self._mm, mmap.mmap):
+				self._mm.close()
+		except BufferError:
+			# record views are still alive, the mapping goes away with them
+			pass
+		self._f.close()
+
+	def skip_newlines(self, pos):
+		mm = self._mm
+		size = self.size
+		while pos < size and mm[pos] in NEWLINE_BYTES:
+			pos += 1
+		return pos
+
+	def record_end(self, start):
+		'''
+			Description:
+				end offset of the record starting at start
+		'''
+		count_at = start + SEG_COUNT_OFFSET
+		if count_at + 2 > self.size:
+			raise Fmt4FormatError(self.path, start, 'truncated header')
+		raw = self._mm[count_at:count_at+2]
+		if not raw.isdigit():
+			raise Fmt4FormatError(self.path, start, 'bad segment count {!r}'.format(raw))
+		end = start + SEGMENT_OFFSET + SEGMENT_SIZE * int(raw)
+		if end > self.size:
+			raise Fmt4FormatError(self.path, start, 'truncated test day segments')
+		return end
+
+	def records(self, start=0, end=None, predicate=None):
+		'''
+			Description:
+				yield (offset, record) for every record starting in [start, end),
+				record is a memoryview of header 1 + header 2 + segments
+			Input:
+				start: must be a record boundary (or newlines before one)
+				end: stop before the first record starting at or after end
+				predicate: called as predicate(mmap, offset) on the raw bytes,
+					records it rejects are skipped without building a view
+		'''
+		if end is None or end > self.size:
+			end = self.size
+		buf = self.buf
+		mm = self._mm
+		pos = self.skip_newlines(start)
+		while pos < end:
+			rec_end = self.record_end(pos)
+			if predicate is None or predicate(mm, pos):
+				yield pos, buf[pos:rec_end]
+			pos = self.skip_newlines(rec_end)
+
+	def batches(self, batch_size, start=0, end=None, predicate=None):
+		'''
+			Description:
+				yield (buf, base, offsets, seg_counts) for batches of up to
+				batch_size records, offsets being relative to buf and
+				base + offset the position in the file (always 0 here)
+		'''
+		offsets = []
+		seg_counts = []
+		for offset, rec in self.records(start, end, predicate):
+			offsets.append(offset)
+			seg_counts.append(segment_count(rec))
+			if len(offsets) == batch_size:
+				yield self._mm, 0, offsets, seg_counts
+				offsets = []
+				seg_counts = []
+		if offsets:
+			yield self._mm, 0, offsets, seg_counts
+
+	def count(self, start=0, end=None):
+		'''
+			Description:
+				number of records and test day segments in [start, end)
+				without building record views
+		'''
+		if end is None or end > self.size:
+			end = self.size
+		n_records = 0
+		n_segments = 0
+		pos = self.skip_newlines(start)
+		while pos < end:
+			rec_end = self.record_end(pos)
+			n_records += 1
+			n_segments += (rec_end - pos - SEGMENT_OFFSET) // SEGMENT_SIZE
+			pos = self.skip_newlines(rec_end)
+		return n_records, n_segments
+
+	def shard_boundaries(self, n_shards):
+		'''
+			Description:
+				record starts at roughly even byte offsets, found by hopping from
+				record to record on the segment counts only
+			Output:
+				up to n_shards + 1 offsets, the first is 0 and the last the file
+				size; shards with no record start in them are dropped
+		'''
+		targets = [self.size * k // n_shards for k in range(1, n_shards)]
+		bounds = [0]
+		pos = self.skip_newlines(0)
+		for target in targets:
+			while pos < target:
+				pos = self.skip_newlines(self.record_end(pos))
+			if pos > bounds[-1] and pos < self.size:
+				bounds.append(pos)
+		bounds.append(self.size)
+		return bounds
+
+	def __iter__(self):
+		return self.records()
+
+
+class Fmt4BytesReader(Fmt4Reader):
+	'''
+		Description:
+			Fmt4Reader over an in-memory block of whole records, e.g. a
+			batch handed to another process
+		Input:
+			data: bytes of the records
+			path: name used in error messages
+	'''
+	def __init__(self, data, path='<bytes>'):
+		self.path = path
+		self._mm = data
+		self.size = len(data)
+		self.buf = memoryview(data)
+
+	def close(self):
+		self.buf.release()
+
+
+class Fmt4StreamReader(object):
+	'''
+		Description:
+			sequential reader of a compressed fmt4 file, decompression runs in a
+			background thread feeding at most queue_size chunks of chunk_size
+			bytes, so it overlaps with record decoding in the caller
+		Input:
+			path: gzip, bz2 or xz compressed fmt4 file
+			opener: gzip.open, bz2.open or lzma.open
+	'''
+	def __init__(self, path, opener, chunk_size=1 << 22, queue_size=4):
+		self.path = path
+		self.opener = opener
+		self.chunk_size = chunk_size
+		self.queue_size = queue_size
+		# decompressed bytes behind the last scan once it stopped
+		self.consumed = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		pass
+
+	def _chunks(self):
+		chunks = queue.Queue(self.queue_size)
+		stop = threading.Event()
+
+		def put(item):
+			while not stop.is_set():
+				try:
+					chunks.put(item, timeout=0.1)
+					return True
+				except queue.Full:
+					pass
+			return False
+
+		def decompress():
+			try:
+				with self.opener(self.path, 'rb') as f:
+					while True:
+						data = f.read(self.chunk_size)
+						if not put(data) or not data:
+							return
+			except Exception as e:
+				put(e)
+
+		thread = threading.Thread(target=decompress, name='fmt4-decompress', daemon=True)
+		thread.start()
+		try:
+			while True:
+				item = chunks.get()
+				if isinstance(item, Exception):
+					raise item
+				if not item:
+					return
+				yield item
+		finally:
+			stop.set()
+			thread.join()
+
+	def _scan(self, start=0, end=None, predicate=None):
+		'''
+			Description:
+				yield (buf, base, pos, rec_end) of the accepted records, buf being
+				the bytes holding the record and base its position in the file;
+				a new buf only carries over the unread tail of the previous one
+		'''
+		chunks = self._chunks()
+		buf = b''
+		base = 0
+		pos = 0
+		eof = False
+		self.consumed = 0
+
+		def refill(buf, base, pos):
+			more = next(chunks, b'')
+			return buf[pos:] + more, base + pos, 0, not more
+
+		while True:
+			while True:
+				size = len(buf)
+				while pos < size and buf[pos] in NEWLINE_BYTES:
+					pos += 1
+				if pos < size or eof:
+					break
+				buf, base, pos, eof = refill(buf, base, pos)
+			if pos >= len(buf):
+				self.consumed = base + len(buf)
+				return
+			while len(buf) < pos + SEGMENT_OFFSET and not eof:
+				buf, base, pos, eof = refill(buf, base, pos)
+			if len(buf) < pos + SEGMENT_OFFSET:
+				raise Fmt4FormatError(self.path, base + pos, 'truncated header')
+			raw = buf[pos+SEG_COUNT_OFFSET:pos+SEG_COUNT_OFFSET+2]
+			if not raw.isdigit():
+				raise Fmt4FormatError(self.path, base + pos, 'bad segment count {!r}'.format(raw))
+			rec_end = pos + SEGMENT_OFFSET + SEGMENT_SIZE * int(raw)
+			while len(buf) < rec_end and not eof:
+				buf, base, pos, eof = refill(buf, base, pos)
+				rec_end = pos + SEGMENT_OFFSET + SEGMENT_SIZE * int(raw)
+			if len(buf) < rec_end:
+				raise Fmt4FormatError(self.path, base + pos, 'truncated test day segments')
+			if end is not None and base + pos >= end:
+				self.consumed = base + pos
+				return
+			if base + pos >= start and (predicate is None or predicate(buf, pos)):
+				yield buf, base, pos, rec_end
+			pos = rec_end
+
+	def records(self, start=0, end=None, predicate=None):
+		'''
+			Description:
+				same as Fmt4Reader.records, records before start are read and skipped
+		'''
+		view_of = None
+		view = None
+		for buf, base, pos, rec_end in self._scan(start, end, predicate):
+			if buf is not view_of:
+				view_of = buf
+				view = memoryview(buf)
+			yield base + pos, view[pos:rec_end]
+
+	def batches(self, batch_size, start=0, end=None, predicate=None):
+		'''
+			Description:
+				same as Fmt4Reader.batches, a batch never spans two buffers
+		'''
+		batch_buf = None
+		batch_base = 0
+		offsets = []
+		seg_counts = []
+		for buf, base, pos, rec_end in self._scan(start, end, predicate):
+			if buf is not batch_buf or len(offsets) == batch_size:
+				if offsets:
+					yield batch_buf, batch_base, offsets, seg_counts
+				batch_buf = buf
+				batch_base = base
+				offsets = []
+				seg_counts = []
+			offsets.append(pos)
+			seg_counts.append((rec_end - pos - SEGMENT_OFFSET) // SEGMENT_SIZE)
+		if offsets:
+			yield batch_buf, batch_base, offsets, seg_counts
+
+	def __iter__(self):
+		return self.records()
+
+
+def open_fmt4(path, **kwargs):
+	'''
+		Description:
+			Fmt4StreamReader for gzip/bz2/xz compressed files, Fmt4Reader otherwise
+	'''
+	with open(path, 'rb') as f:
+		magic = f.read(6)
+	for prefix, opener in COMPRESSED_MAGIC:
+		if magic.startswith(prefix):
+			return Fmt4StreamReader(path, opener, **kwargs)
+	return Fmt4Reader(path)
@@ -0,0 +1,116 @@
+'''
+Uniform and stratified sampling of fmt4 records in one streaming pass.
+
+Reservoir keeps a uniform sample of k items with Li's algorithm L: after
+the first k items it draws how many items to skip before the next one is
+taken, so skipped records cost one counter increment and are never copied.
+SampledReader wraps a reader and hands out, in file order, a sample of the
+records accepted by the reader predicate: uniform over the whole input, or
+k per stratum when strata are given, strata being fmt4_filter.CLAUSES names
+(breed, state, birth_year, ...) whose raw header bytes form the stratum
+key, so nothing is decoded to place a record. Memory is bounded by the
+sampled records (k per stratum).
+'''
+
+import math
+import random
+
+from fmt4_filter import CLAUSES
+
+
+class Reservoir(object):
+	'''
+		Description:
+			uniform sample of k items out of a stream of unknown length
+		Input:
+			rng: random.Random shared by the reservoirs of one sampling pass
+	'''
+	def __init__(self, k, rng):
+		self.k = k
+		self.rng = rng
+		self.items = []
+		self.seen = 0
+		self._w = 1.0
+		self._next = k
+
+	def _skip(self):
+		# 1 - random() is in (0, 1], keeping log() finite
+		self._w *= math.exp(math.log(1.0 - self.rng.random()) / self.k)
+		if self._w >= 1.0:
+			self._next += 1
+		else:
+			self._next += int(math.log(1.0 - self.rng.random()) / math.log(1.0 - self._w)) + 1
+
+	def wants(self):
+		'''
+			Description:
+				count one more stream item, True if it goes into the sample (then call add)
+		'''
+		self.seen += 1
+		return self.seen <= self.k or self.seen == self._next
+
+	def add(self, item):
+		if len(self.items) < self.k:
+			self.items.append(item)
+			if len(self.items) == self.k:
+				self._skip()
+		else:
+			self.items[self.rng.randrange(self.k)] = item
+			self._skip()
+
+
+class SampledReader(object):
+	'''
+		Description:
+			reader over a sample of the records of another reader
+		Input:
+			reader: Fmt4Reader or Fmt4StreamReader
+			k: sample size, per stratum when strata are given
+			strata: fmt4_filter.CLAUSES names forming the stratum key
+			seed: random seed, equal seeds give equal samples of the same input
+	'''
+	def __init__(self, reader, k, strata=(), seed=0):
+		unknown = [name for name in strata if name not in CLAUSES]
+		if unknown:
+			raise ValueError('unknown strata {}'.format(unknown))
+		self.reader = reader
+		self.k = k
+		self.strata = list(strata)
+		self.seed = seed
+		self.reservoirs = {}
+
+	def sample(self, start=0, end=None, predicate=None):
+		'''
+			Description:
+				one pass over the records accepted by predicate
+			Output:
+				list of (offset, record bytes) in file order
+		'''
+		rng = random.Random(self.seed)
+		slices = [(CLAUSES[name][0], CLAUSES[name][0] + CLAUSES[name][1]) for name in self.strata]
+		reservoirs = self.reservoirs = {}
+		for offset, rec in self.reader.records(start, end, predicate):
+			key = tuple(bytes(rec[a:b]) for a, b in slices)
+			reservoir = reservoirs.get(key)
+			if reservoir is None:
+				reservoir = reservoirs[key] = Reservoir(self.k, rng)
+			if reservoir.wants():
+				reservoir.add((offset, bytes(rec)))
+		return sorted(item for reservoir in reservoirs.values() for item in reservoir.items)
+
+	@property
+	def consumed(self):
+		# the sample is drawn from the whole input
+		return getattr(self.reader, 'size', getattr(self.reader, 'consumed', None))
+
+	def records(self, start=0, end=None, predicate=None):
+		for offset, rec in self.sample(start, end, predicate):
+			yield offset, memoryview(rec)
+
+	def strata_counts(self):
+		'''
+			Description:
+				{stratum key: (records seen, records sampled)} of the last pass
+		'''
+		return dict((tuple(value.decode('ascii', 'replace') for value in key), (reservoir.seen, len(reservoir.items)))
+			for key, reservoir in self.reservoirs.items())
@@ -0,0 +1,214 @@
+'''
+Out-of-core sort of fmt4 lactations into per-animal lifetime histories.
+
+Lactation headers are decoded into a structured array, cut into sorted runs
+on disk, and the runs are k-way merged block by block: every round takes
+from each run the records up to the smallest last key among the current
+blocks, so the merged output is final and memory stays at one block per
+run. Records are ordered by (animal_breed_code, animal_id_number,
+calving_date). memory_budget covers the working arrays: a quarter of it
+goes to decoding batches, up to a quarter to the decompressed chunks of
+gzip/bz2/xz inputs, the rest to the run buffer with its sort keys and
+order, and a run is written out through a memmap in small chunks rather
+than as a sorted copy.
+'''
+
+import argparse
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from fmt4_decode import iter_lactations
+from fmt4_layout import HEADER_FIELDS, HEADER_NAMES, field_dtype
+
+SORT_KEY = ('animal_breed_code', 'animal_id_number', 'calving_date')
+ANIMAL_KEY = SORT_KEY[:2]
+
+LACTATION_DTYPE = np.dtype([(name, field_dtype(kind, width)) for name, offset, width, kind in HEADER_FIELDS] +
+	[('source', np.uint16), ('offset', np.int64)])
+
+_KEY_DTYPE = np.dtype([('breed', 'S2'), ('animal', 'S12'), ('calving', '>u4')])
+
+# working bytes per record, measured with tracemalloc: decoding the
+# LACTATION_DTYPE header fields (gather index, byte block, digits, columns)
+# and sorting a run (key, argsort order and its merge buffer)
+_DECODE_BYTES = 1280
+_SORT_BYTES = 32
+# records copied at once when writing a run in sorted order
+_WRITE_RECORDS = 4096
+# Fmt4StreamReader chunks alive at once: the queued ones, the one being
+# decompressed, and the reader's current buffer, its refill and the buffer of
+# the batch being handed out
+_STREAM_QUEUE = 2
+_STREAM_CHUNKS = _STREAM_QUEUE + 4
+_MIN_CHUNK = 1 << 16
+_MAX_CHUNK = 1 << 22
+
+
+def sort_keys(lactations):
+	'''
+		Description:
+			fixed width byte keys that order like SORT_KEY, for searchsorted
+	'''
+	keys = np.empty(len(lactations), dtype=_KEY_DTYPE)
+	keys['breed'] = lactations['animal_breed_code']
+	keys['animal'] = lactations['animal_id_number']
+	keys['calving'] = lactations['calving_date'].astype(np.int64) + 2 ** 31
+	return keys.view('V{}'.format(_KEY_DTYPE.itemsize)).view('S{}'.format(_KEY_DTYPE.itemsize))
+
+
+def _sorted(lactations):
+	return lactations[np.argsort(sort_keys(lactations), kind='stable')]
+
+
+def _write_sorted_run(run_path, lactations):
+	# sorted by chunks through a memmap instead of a sorted copy of the whole run
+	order = np.argsort(sort_keys(lactations), kind='stable')
+	out = open_memmap(run_path, mode='w+', dtype=LACTATION_DTYPE, shape=(len(lactations),))
+	for start in range(0, len(order), _WRITE_RECORDS):
+		out[start:start+_WRITE_RECORDS] = lactations[order[start:start+_WRITE_RECORDS]]
+	out.flush()
+	del out
+
+
+def write_runs(paths, run_dir, memory_budget=1 << 28, predicate=None):
+	'''
+		Description:
+			decode the lactations of the fmt4 files in paths into sorted .npy runs
+		Output:
+			list of run file paths
+	'''
+	batch_records = min(100000, max(1, memory_budget // 4 // _DECODE_BYTES))
+	chunk_size = min(_MAX_CHUNK, max(_MIN_CHUNK, memory_budget // 4 // _STREAM_CHUNKS))
+	working = batch_records * _DECODE_BYTES + chunk_size * _STREAM_CHUNKS
+	run_records = max(1, (memory_budget - working) // (LACTATION_DTYPE.itemsize + _SORT_BYTES))
+	fields = [name for name in LACTATION_DTYPE.names if name in HEADER_NAMES]
+	runs = []
+	buffer = np.empty(run_records, dtype=LACTATION_DTYPE)
+	filled = 0
+
+	def flush(filled):
+		run_path = os.path.join(run_dir, 'run{}.npy'.format(len(runs)))
+		_write_sorted_run(run_path, buffer[:filled])
+		runs.append(run_path)
+
+	for source, path in enumerate(paths):
+		for columns, seg_columns, seg_index in iter_lactations(path, fields, seg_fields=[], batch_size=batch_records,
+				predicate=predicate, chunk_size=chunk_size, queue_size=_STREAM_QUEUE):
+			columns['source'] = np.full(len(columns['offset']), source, dtype=np.uint16)
+			n = len(columns['offset'])
+			done = 0
+			while done < n:
+				take = min(n - done, run_records - filled)
+				for name in LACTATION_DTYPE.names:
+					buffer[name][filled:filled+take] = columns[name][done:done+take]
+				filled += take
+				done += take
+				if filled == run_records:
+					flush(filled)
+					filled = 0
+	if filled:
+		flush(filled)
+	return runs
+
+
+def _block_records(memory_budget, n_runs):
+	# a round holds the keys of every block, the concatenated records taken
+	# from them and their sorted copy with its keys and order
+	return max(1, memory_budget // ((2 * LACTATION_DTYPE.itemsize + 2 * _SORT_BYTES) * max(1, n_runs)))
+
+
+def merge_runs(run_paths, block_records=65536):
+	'''
+		Description:
+			k-way merge of sorted runs, yields sorted blocks of lactations
+	'''
+	runs = [np.load(path, mmap_mode='r') for path in run_paths]
+	positions = [0] * len(runs)
+	while True:
+		active = [k for k in range(len(runs)) if positions[k] < len(runs[k])]
+		if not active:
+			return
+		blocks = dict((k, runs[k][positions[k]:positions[k]+block_records]) for k in active)
+		keys = dict((k, sort_keys(blocks[k])) for k in active)
+		bound = min(keys[k][-1] for k in active)
+		parts = []
+		for k in active:
+			n = np.searchsorted(keys[k], bound, 'right')
+			parts.append(blocks[k][:n])
+			positions[k] += n
+		yield _sorted(np.concatenate(parts))
+
+
+def sort_lactations(paths, memory_budget=1 << 28, tmp_dir=None, predicate=None):
+	'''
+		Description:
+			yield sorted blocks of the lactations of all fmt4 files in paths,
+			the runs are removed once the generator finishes
+	'''
+	run_dir = tempfile.mkdtemp(prefix='fmt4_sort_', dir=tmp_dir)
+	try:
+		run_paths = write_runs(paths, run_dir, memory_budget, predicate)
+		# one block per run held at a time
+		block_records = _block_records(memory_budget, len(run_paths))
+		for block in merge_runs(run_paths, block_records):
+			yield block
+	finally:
+		shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def iter_histories(paths, memory_budget=1 << 28, tmp_dir=None, predicate=None):
+	'''
+		Description:
+			yield the lactations of each animal ordered by calving date,
+			as a structured array of LACTATION_DTYPE
+	'''
+	carry = None
+	for block in sort_lactations(paths, memory_budget, tmp_dir, predicate):
+		if carry is not None:
+			block = np.concatenate([carry, block])
+		animals = sort_keys(block).astype('S14')
+		starts = np.flatnonzero(np.r_[True, animals[1:] != animals[:-1]])
+		# the last animal may continue in the next block
+		for a, b in zip(starts[:-1], starts[1:]):
+			yield block[a:b]
+		carry = block[starts[-1]:]
+	if carry is not None and len(carry):
+		yield carry
+
+
+def write_sorted(paths, out_path, memory_budget=1 << 28, tmp_dir=None, predicate=None):
+	'''
+		Description:
+			write all lactations sorted by SORT_KEY into one .npy file
+		Output:
+			number of lactations written
+	'''
+	run_dir = tempfile.mkdtemp(prefix='fmt4_sort_', dir=tmp_dir)
+	try:
+		run_paths = write_runs(paths, run_dir, memory_budget, predicate)
+		total = sum(len(np.load(path, mmap_mode='r')) for path in run_paths)
+		out = open_memmap(out_path, mode='w+', dtype=LACTATION_DTYPE, shape=(total,))
+		block_records = _block_records(memory_budget, len(run_paths))
+		row = 0
+		for block in merge_runs(run_paths, block_records):
+			out[row:row+len(block)] = block
+			row += len(block)
+		out.flush()
+		del out
+	finally:
+		shutil.rmtree(run_dir, ignore_errors=True)
+	return total
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='sort fmt4 lactations by animal and calving date')
+	parser.add_argument('inputs', nargs='+')
+	parser.add_argument('output', help='.npy file of the sorted lactations')
+	parser.add_argument('--memory', type=int, default=256, help='memory budget in MB')
+	parser.add_argument('--tmp-dir', help='directory for the sorted runs')
+	args = parser.parse_args()
+	print(write_sorted(args.inputs, args.output, args.memory << 20, args.tmp_dir))
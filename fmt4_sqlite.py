@@ -0,0 +1,193 @@
+'''
+Bulk export of fmt4 files into an indexed SQLite database.
+
+Tables
+	source_file: one row per loaded input (path, size, mtime, sha256, records)
+	lactation: source_id, record_offset and every fmt4_layout header field
+	test_day: source_id, record_offset, test_day and every segment field
+Decoded columns are turned into rows a batch at a time and inserted with
+executemany, each input file being loaded in one transaction with
+synchronous off. The secondary indexes (animal id, herd, calving date and
+the source record of lactations and test days) are dropped before a load
+and built once after it. Inputs already in source_file with the same size
+and mtime (or content hash) are skipped; inputs whose content changed have
+their rows replaced. Missing values are NULL and dates are ISO
+'YYYY-MM-DD' text.
+'''
+
+import argparse
+import os
+import sqlite3
+
+import numpy as np
+
+from fmt4_decode import iter_lactations
+from fmt4_filter import Fmt4Filter
+from fmt4_ingest import FMT4_SUFFIXES, file_hash
+from fmt4_layout import HEADER_FIELDS, MISSING, MISSING_DATE, SEGMENT_FIELDS
+
+PRAGMAS = [
+	'PRAGMA journal_mode=WAL',
+	'PRAGMA synchronous=OFF',
+	'PRAGMA temp_store=MEMORY',
+	'PRAGMA cache_size=-262144',
+]
+
+INDEXES = [
+	('lactation_animal', 'lactation', 'animal_id_number, animal_breed_code'),
+	('lactation_herd', 'lactation', 'herd_state_code, herd_county_code, cow_ctrl_number'),
+	('lactation_calving', 'lactation', 'calving_date'),
+	('lactation_record', 'lactation', 'source_id, record_offset'),
+	('test_day_record', 'test_day', 'source_id, record_offset'),
+]
+
+_SQL_TYPES = {'str': 'TEXT', 'code': 'TEXT', 'date': 'TEXT', 'int': 'INTEGER'}
+
+
+def _schema():
+	lactation = ', '.join('{} {}'.format(name, _SQL_TYPES[kind]) for name, offset, width, kind in HEADER_FIELDS)
+	test_day = ', '.join('{} {}'.format(name, _SQL_TYPES[kind]) for name, offset, width, kind in SEGMENT_FIELDS)
+	return [
+		'CREATE TABLE IF NOT EXISTS source_file (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, '
+			'mtime REAL, sha256 TEXT, records INTEGER)',
+		'CREATE TABLE IF NOT EXISTS lactation (source_id INTEGER, record_offset INTEGER, {})'.format(lactation),
+		'CREATE TABLE IF NOT EXISTS test_day (source_id INTEGER, record_offset INTEGER, test_day INTEGER, {})'.format(test_day),
+	]
+
+
+def _sql_column(values, kind):
+	# decoded column -> list of python values, None for missing
+	if kind == 'str':
+		return np.char.decode(values, 'ascii').tolist()
+	if kind == 'code':
+		return values.view('S1').astype('U1').tolist()
+	if kind == 'date':
+		column = values.astype(np.int64).astype('M8[D]').astype(str).astype(object)
+		column[values == MISSING_DATE] = None
+		return column.tolist()
+	column = values.astype(object)
+	column[values == MISSING] = None
+	return column.tolist()
+
+
+def connect(db_path):
+	'''
+		Description:
+			open (creating if needed) the export database with the bulk load pragmas
+	'''
+	connection = sqlite3.connect(db_path, isolation_level=None)
+	for pragma in PRAGMAS:
+		connection.execute(pragma)
+	for statement in _schema():
+		connection.execute(statement)
+	return connection
+
+
+def drop_indexes(connection):
+	for name, table, columns in INDEXES:
+		connection.execute('DROP INDEX IF EXISTS {}'.format(name))
+
+
+def create_indexes(connection):
+	for name, table, columns in INDEXES:
+		connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(name, table, columns))
+	connection.execute('ANALYZE')
+
+
+def load_file(connection, path, source_id, predicate=None, batch_size=50000):
+	'''
+		Description:
+			insert the lactations and test days of one fmt4 file, in the
+			caller's transaction
+		Output:
+			number of lactations inserted
+	'''
+	lactation_sql = 'INSERT INTO lactation VALUES ({})'.format(', '.join(['?'] * (len(HEADER_FIELDS) + 2)))
+	test_day_sql = 'INSERT INTO test_day VALUES ({})'.format(', '.join(['?'] * (len(SEGMENT_FIELDS) + 3)))
+	count = 0
+	for columns, seg_columns, seg_index in iter_lactations(path, batch_size=batch_size, predicate=predicate):
+		n = len(columns['offset'])
+		offsets = columns['offset'].tolist()
+		values = [_sql_column(columns[name], kind) for name, offset, width, kind in HEADER_FIELDS]
+		connection.executemany(lactation_sql, zip([source_id] * n, offsets, *values))
+		seg_counts = np.diff(seg_index)
+		seg_offsets = np.repeat(columns['offset'], seg_counts)
+		test_days = np.arange(seg_index[-1]) - np.repeat(seg_index[:-1], seg_counts)
+		seg_values = [_sql_column(seg_columns[name], kind) for name, offset, width, kind in SEGMENT_FIELDS]
+		connection.executemany(test_day_sql, zip([source_id] * len(test_days), seg_offsets.tolist(), test_days.tolist(),
+			*seg_values))
+		count += n
+	return count
+
+
+def _known_source(connection, path):
+	return connection.execute('SELECT id, size, mtime, sha256 FROM source_file WHERE path = ?', (path,)).fetchone()
+
+
+def export(db_path, paths, predicate=None, rebuild_indexes=True, batch_size=50000):
+	'''
+		Description:
+			load the new or changed fmt4 files of paths into the database at db_path
+		Input:
+			predicate: Fmt4Filter (or any reader predicate), None loads every record
+			rebuild_indexes: drop the indexes before loading and build them
+				after, False keeps them (cheaper for small increments)
+		Output:
+			{path: lactations loaded} for the files loaded by this run
+	'''
+	connection = connect(db_path)
+	loaded = {}
+	try:
+		todo = []
+		for path in paths:
+			path = os.path.abspath(path)
+			st = os.stat(path)
+			known = _known_source(connection, path)
+			if known is not None and known[1] == st.st_size and known[2] == st.st_mtime:
+				continue
+			digest = file_hash(path)
+			if known is not None and known[3] == digest:
+				connection.execute('UPDATE source_file SET mtime = ? WHERE id = ?', (st.st_mtime, known[0]))
+				continue
+			todo.append((path, st, digest, known))
+		if todo and rebuild_indexes:
+			drop_indexes(connection)
+		for path, st, digest, known in todo:
+			# one transaction per file, an interrupted run leaves no partial file behind
+			connection.execute('BEGIN')
+			if known is not None:
+				connection.execute('DELETE FROM lactation WHERE source_id = ?', (known[0],))
+				connection.execute('DELETE FROM test_day WHERE source_id = ?', (known[0],))
+				connection.execute('DELETE FROM source_file WHERE id = ?', (known[0],))
+			source_id = connection.execute('INSERT INTO source_file (path, size, mtime, sha256) VALUES (?, ?, ?, ?)',
+				(path, st.st_size, st.st_mtime, digest)).lastrowid
+			count = load_file(connection, path, source_id, predicate, batch_size)
+			connection.execute('UPDATE source_file SET records = ? WHERE id = ?', (count, source_id))
+			connection.execute('COMMIT')
+			loaded[path] = count
+		create_indexes(connection)
+	finally:
+		connection.close()
+	return loaded
+
+
+def _input_files(inputs):
+	for path in inputs:
+		if os.path.isdir(path):
+			for file_name in sorted(os.listdir(path)):
+				if file_name.endswith(FMT4_SUFFIXES):
+					yield os.path.join(path, file_name)
+		else:
+			yield path
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='load fmt4 files into an SQLite database')
+	parser.add_argument('database')
+	parser.add_argument('inputs', nargs='+', help='fmt4 files or directories of them')
+	parser.add_argument('--where', action='append', default=[], help='filter clause, see fmt4_csv --where')
+	parser.add_argument('--keep-indexes', action='store_true', help='load with the indexes in place')
+	args = parser.parse_args()
+	predicate = Fmt4Filter.parse(args.where) if args.where else None
+	for path, count in sorted(export(args.database, list(_input_files(args.inputs)), predicate, not args.keep_indexes).items()):
+		print(path, count)
@@ -0,0 +1,150 @@
+'''
+Conversion instrumentation.
+
+ConversionStats counts bytes read, records seen and written, segments
+decoded and the records rejected by each filter clause (by name, from
+Fmt4Filter.reason), and splits the wall time of the conversion loop into
+read / decode / encode / write with one perf_counter call per stage. Every
+`every` seconds, and once at the end, it appends a JSON line with the
+totals and the MB/s and records/s since the previous line to the stats
+file. NULL_STATS has the same methods doing nothing, so the converters
+call them unconditionally.
+'''
+
+import json
+import time
+
+STAGES = ('read', 'decode', 'encode', 'write')
+
+
+class NullStats(object):
+	def counting(self, predicate):
+		return predicate
+
+	def lap(self, stage):
+		pass
+
+	def record(self, position, n_segments):
+		pass
+
+	def finish(self, position=None):
+		pass
+
+
+NULL_STATS = NullStats()
+
+
+class ConversionStats(object):
+	'''
+		Description:
+			counters and stage timers of one conversion (or one shard of it)
+		Input:
+			path: JSON-lines file the counters are appended to, None to only count
+			every: seconds between two lines
+			start: input offset the conversion starts at
+			labels: extra fields written on every line (input, shard, ...)
+	'''
+	def __init__(self, path=None, every=10.0, start=0, **labels):
+		self.path = path
+		self.every = every
+		self.labels = labels
+		self.start = start
+		self.position = start
+		self.records_written = 0
+		self.segments = 0
+		self.rejected = {}
+		self.seconds = dict((stage, 0.0) for stage in STAGES)
+		self._started = self._last = time.perf_counter()
+		self._next_emit = self._started + every
+		self._emitted = (self._started, 0, 0)
+
+	@property
+	def records_seen(self):
+		return self.records_written + sum(self.rejected.values())
+
+	def counting(self, predicate):
+		'''
+			Description:
+				wrap a reader predicate so its rejections are counted, per
+				clause for an Fmt4Filter
+		'''
+		if predicate is None:
+			return None
+		rejected = self.rejected
+		reason = getattr(predicate, 'reason', None)
+		if reason is None:
+			def counted(buf, pos):
+				if predicate(buf, pos):
+					return True
+				rejected['predicate'] = rejected.get('predicate', 0) + 1
+				return False
+			return counted
+
+		def counted(buf, pos):
+			name = reason(buf, pos)
+			if name is None:
+				return True
+			rejected[name] = rejected.get(name, 0) + 1
+			return False
+		return counted
+
+	def lap(self, stage):
+		'''
+			Description:
+				charge the time since the previous lap to stage
+		'''
+		now = time.perf_counter()
+		self.seconds[stage] += now - self._last
+		self._last = now
+		if now >= self._next_emit:
+			self.emit(now)
+
+	def record(self, position, n_segments):
+		'''
+			Description:
+				one record written, position being the input offset after it
+		'''
+		self.position = position
+		self.records_written += 1
+		self.segments += n_segments
+
+	def snapshot(self, now=None):
+		now = time.perf_counter() if now is None else now
+		emitted_at, emitted_bytes, emitted_records = self._emitted
+		bytes_read = self.position - self.start
+		records_seen = self.records_seen
+		interval = max(now - emitted_at, 1e-9)
+		state = dict(self.labels)
+		state.update({
+			'time': time.time(),
+			'elapsed': round(now - self._started, 3),
+			'bytes_read': bytes_read,
+			'records_seen': records_seen,
+			'records_written': self.records_written,
+			'records_rejected': dict(self.rejected),
+			'segments': self.segments,
+			'seconds': dict((stage, round(value, 3)) for stage, value in self.seconds.items()),
+			'mb_per_s': round((bytes_read - emitted_bytes) / interval / 1e6, 3),
+			'records_per_s': round((records_seen - emitted_records) / interval, 1),
+		})
+		return state
+
+	def emit(self, now=None, final=False):
+		now = time.perf_counter() if now is None else now
+		state = self.snapshot(now)
+		state['final'] = final
+		if self.path is not None:
+			with open(self.path, 'a') as f:
+				f.write(json.dumps(state) + '\n')
+		self._emitted = (now, state['bytes_read'], state['records_seen'])
+		self._next_emit = now + self.every
+		return state
+
+	def finish(self, position=None):
+		'''
+			Description:
+				write the final line, position being where the conversion stopped reading
+		'''
+		if position is not None:
+			self.position = max(self.position, position)
+		return self.emit(final=True)
@@ -0,0 +1,250 @@
+'''
+Synthetic fmt4 fixture generator.
+
+Writes valid fmt4 files following the fmt4_layout header 1 / header 2 /
+test day segment layout, so parsers and the benchmark can run without
+real CDCB data. Records are built a whole batch at a time in one uint8
+buffer. Animals get consecutive lactations with increasing lactation
+numbers and calving dates; test day milk follows a Wood curve with noise
+(test day milk in tenths of a pound, fat and protein percent and SCS in
+tenths). Output is fully determined by the seed and the parameters.
+'''
+
+import argparse
+
+import numpy as np
+
+from fmt4_layout import HEADER_FIELDS, SEGMENT_FIELDS
+from fmt4_reader import SEGMENT_OFFSET, SEGMENT_SIZE
+
+DEFAULT_BREEDS = {'HO': 0.85, 'JE': 0.1, 'BS': 0.05}
+DEFAULT_BIRTH_YEARS = dict((year, 1.0) for year in range(2000, 2016))
+DEFAULT_RECORD_TYPES = {'X': 0.4, 'L': 0.3, 'R': 0.1, 'Y': 0.1, 'C': 0.05, 'Z': 0.05}
+DEFAULT_LACTATION_TYPES = {'0': 0.3, '1': 0.3, '2': 0.2, '5': 0.05, '6': 0.05, '7': 0.02, '8': 0.03, '3': 0.05}
+DEFAULT_SEG_COUNTS = dict((n, 1.0) for n in range(0, 13))
+
+_FIELDS = dict((name, (offset, width)) for name, offset, width, kind in HEADER_FIELDS)
+_SEG_FIELDS = dict((name, (offset, width)) for name, offset, width, kind in SEGMENT_FIELDS)
+
+
+def parse_mix(text, key=str):
+	'''
+		Description:
+			'a:0.5,b:0.5' -> {a: 0.5, b: 0.5}
+	'''
+	mix = {}
+	for item in text.split(','):
+		value, _, weight = item.partition(':')
+		mix[key(value)] = float(weight or 1)
+	return mix
+
+
+def _choice(rng, mix, n):
+	values = list(mix)
+	p = np.array([mix[value] for value in values], dtype=float)
+	return np.array(values)[rng.choice(len(values), n, p=p / p.sum())]
+
+
+def _put_digits(buf, starts, values, width):
+	pow10 = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+	digits = (np.asarray(values, dtype=np.int64)[:, None] // pow10) % 10 + 48
+	buf[starts[:, None] + np.arange(width)] = digits
+
+
+def _put_chars(buf, starts, values, width):
+	raw = np.asarray(values, dtype='S{}'.format(width)).view(np.uint8).reshape(-1, width)
+	buf[starts[:, None] + np.arange(width)] = raw
+
+
+def _put_dates(buf, starts, days):
+	days = days.astype('M8[D]')
+	months = days.astype('M8[M]')
+	year = days.astype('M8[Y]').astype(np.int64) + 1970
+	month = months.astype(np.int64) % 12 + 1
+	day = (days - months.astype('M8[D]')).astype(np.int64) + 1
+	_put_digits(buf, starts, year * 10000 + month * 100 + day, 8)
+
+
+class Fmt4Synth(object):
+	'''
+		Description:
+			generator of fmt4 record batches
+		Input:
+			seed: random seed, equal seeds and parameters give equal files
+			breeds, birth_years, record_types, lactation_types, seg_counts:
+				{value: weight} mixes
+			newline: end every record with a newline
+	'''
+	def __init__(self, seed=0, breeds=DEFAULT_BREEDS, birth_years=DEFAULT_BIRTH_YEARS, record_types=DEFAULT_RECORD_TYPES,
+			lactation_types=DEFAULT_LACTATION_TYPES, seg_counts=DEFAULT_SEG_COUNTS, newline=True):
+		self.rng = np.random.default_rng(seed)
+		self.breeds = breeds
+		self.birth_years = birth_years
+		self.record_types = record_types
+		self.lactation_types = lactation_types
+		self.seg_counts = seg_counts
+		self.newline = newline
+		self.next_animal = 1
+
+	def mean_length(self):
+		'''
+			Description:
+				expected bytes per record
+		'''
+		weights = np.array(list(self.seg_counts.values()), dtype=float)
+		mean_segments = np.dot(list(self.seg_counts), weights) / weights.sum()
+		return SEGMENT_OFFSET + SEGMENT_SIZE * mean_segments + (1 if self.newline else 0)
+
+	def _lactations(self, n):
+		# animals with 1 + geometric lactations each, cut to n records
+		rng = self.rng
+		per_animal = np.minimum(rng.geometric(0.4, n), 10)
+		per_animal = per_animal[:np.searchsorted(np.cumsum(per_animal), n) + 1]
+		animal = np.repeat(np.arange(len(per_animal)), per_animal)[:n]
+		first = np.r_[0, np.flatnonzero(animal[1:] != animal[:-1]) + 1]
+		lactation_num = np.arange(n) - np.repeat(first, np.diff(np.r_[first, n])) + 1
+		ids = self.next_animal + animal
+		self.next_animal += len(per_animal)
+		return animal, ids, lactation_num
+
+	def batch(self, n):
+		'''
+			Description:
+				n records as one uint8 buffer
+		'''
+		rng = self.rng
+		seg_counts = _choice(rng, self.seg_counts, n).astype(np.int64)
+		lengths = SEGMENT_OFFSET + SEGMENT_SIZE * seg_counts + (1 if self.newline else 0)
+		starts = np.r_[0, np.cumsum(lengths)[:-1]]
+		buf = np.full(lengths.sum(), ord('0'), dtype=np.uint8)
+		if self.newline:
+			buf[starts + lengths - 1] = ord('\n')
+
+		def at(name):
+			return starts + _FIELDS[name][0]
+
+		animal, ids, lactation_num = self._lactations(n)
+		n_animals = animal[-1] + 1 if n else 0
+		breed = _choice(rng, self.breeds, n_animals)[animal]
+		birth_year = _choice(rng, self.birth_years, n_animals).astype(np.int64)
+		birth = (np.array(birth_year - 1970, dtype='M8[Y]').astype('M8[D]').astype(np.int64)
+			+ rng.integers(0, 365, n_animals))[animal]
+		calving = birth + 700 + 400 * (lactation_num - 1) + rng.integers(-30, 30, n)
+		# at least one day per test day, see dim_test below
+		dim = np.maximum(rng.integers(30, 400, n), seg_counts)
+		state = rng.integers(1, 56, n_animals)[animal]
+		county = rng.integers(1, 99, n_animals)[animal]
+		herd = rng.integers(0, 99999, n_animals)[animal]
+
+		_put_chars(buf, at('animal_breed_code'), breed, 2)
+		_put_digits(buf, at('animal_id_number'), ids, 12)
+		_put_dates(buf, at('birth_date'), birth)
+		_put_chars(buf, at('record_type'), _choice(rng, self.record_types, n), 1)
+		_put_digits(buf, at('multiple_birth_code'), rng.integers(1, 3, n), 1)
+		_put_digits(buf, at('herd_state_code'), state, 2)
+		_put_digits(buf, at('herd_county_code'), county, 2)
+		_put_digits(buf, at('cow_ctrl_number'), herd, 5)
+		_put_chars(buf, at('lactation_type_code'), _choice(rng, self.lactation_types, n), 1)
+		_put_chars(buf, at('lactation_verify_code'), np.full(n, 'V'), 1)
+		_put_dates(buf, at('calving_date'), calving)
+		_put_digits(buf, at('DIM'), dim, 3)
+		_put_digits(buf, at('days_dry_prior'), np.where(lactation_num > 1, rng.integers(30, 90, n), 0), 3)
+		_put_digits(buf, at('lactation_num'), lactation_num, 2)
+		_put_digits(buf, at('num_seg_test_days'), seg_counts, 2)
+
+		# test days: Wood curve a * t^b * exp(-c t) with parity dependent a
+		n_seg = seg_counts.sum()
+		record = np.repeat(np.arange(n), seg_counts)
+		seg_index = np.r_[0, np.cumsum(seg_counts)]
+		j = np.arange(n_seg) - seg_index[record]
+		seg_starts = starts[record] + SEGMENT_OFFSET + SEGMENT_SIZE * j
+		# test j falls in the j-th of seg_count disjoint, non-empty day ranges
+		# splitting 1..DIM, so test days strictly increase
+		count = np.maximum(seg_counts[record], 1)
+		low = j * dim[record] // count + 1
+		high = (j + 1) * dim[record] // count
+		dim_test = low + (rng.random(n_seg) * (high - low + 1)).astype(np.int64)
+		a = np.where(lactation_num > 1, 23.0, 17.0)[record] * rng.normal(1, 0.1, n_seg)
+		b = rng.normal(0.2, 0.02, n_seg)
+		c = rng.normal(0.003, 0.0003, n_seg)
+		kg = a * dim_test ** b * np.exp(-c * dim_test) * rng.normal(1, 0.05, n_seg)
+		milk = np.clip(np.round(kg / 0.45359237 * 10), 1, 9999)
+
+		def seg_at(name):
+			return seg_starts + _SEG_FIELDS[name][0]
+
+		_put_digits(buf, seg_at('dim_test'), dim_test, 3)
+		_put_chars(buf, seg_at('supervision_code'), np.full(n_seg, 'A'), 1)
+		_put_digits(buf, seg_at('milking_freq'), rng.integers(2, 4, n_seg), 1)
+		_put_digits(buf, seg_at('actual_milk_yield'), milk, 4)
+		_put_digits(buf, seg_at('actual_fat_percent'), rng.integers(30, 45, n_seg), 2)
+		_put_digits(buf, seg_at('actual_protein_percent'), rng.integers(28, 36, n_seg), 2)
+		_put_digits(buf, seg_at('actual_SCS'), rng.integers(10, 60, n_seg), 2)
+		return buf
+
+
+def generate(path, size=None, records=None, batch_size=100000, **kwargs):
+	'''
+		Description:
+			write a synthetic fmt4 file of at least size bytes or exactly records records
+		Input:
+			kwargs: Fmt4Synth parameters
+		Output:
+			(records, bytes) written
+	'''
+	if size is None and records is None:
+		raise ValueError('give size or records')
+	synth = Fmt4Synth(**kwargs)
+	written = 0
+	n_records = 0
+	with open(path, 'wb') as f:
+		while (records is None or n_records < records) and (size is None or written < size):
+			n = batch_size if records is None else min(batch_size, records - n_records)
+			if size is not None:
+				# records left to reach size, at the mean record length so far
+				mean_length = written / n_records if n_records else synth.mean_length()
+				n = min(n, max(1, int((size - written) / mean_length)))
+			buf = synth.batch(n)
+			f.write(buf.data)
+			written += len(buf)
+			n_records += n
+	return n_records, written
+
+
+def parse_size(text):
+	'''
+		Description:
+			'500K', '20M', '2G' -> bytes
+	'''
+	units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+	if text[-1].upper() in units:
+		return int(float(text[:-1]) * units[text[-1].upper()])
+	return int(text)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='write a synthetic fmt4 file')
+	parser.add_argument('output')
+	parser.add_argument('--size', help='target size, e.g. 500M or 2G')
+	parser.add_argument('--records', type=int)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--breeds', help='mix like HO:0.8,JE:0.2')
+	parser.add_argument('--birth-years', help='mix like 2005:1,2010:2')
+	parser.add_argument('--record-types', help='mix like X:0.5,L:0.5')
+	parser.add_argument('--lactation-types', help='mix like 0:0.5,1:0.5')
+	parser.add_argument('--seg-counts', help='segment count mix like 0:1,10:3')
+	parser.add_argument('--no-newline', action='store_true', help='do not end records with a newline')
+	args = parser.parse_args()
+	kwargs = {'seed': args.seed, 'newline': not args.no_newline}
+	if args.breeds:
+		kwargs['breeds'] = parse_mix(args.breeds)
+	if args.birth_years:
+		kwargs['birth_years'] = parse_mix(args.birth_years, int)
+	if args.record_types:
+		kwargs['record_types'] = parse_mix(args.record_types)
+	if args.lactation_types:
+		kwargs['lactation_types'] = parse_mix(args.lactation_types)
+	if args.seg_counts:
+		kwargs['seg_counts'] = parse_mix(args.seg_counts, int)
+	size = parse_size(args.size) if args.size else None
+	print(*generate(args.output, size, args.records, **kwargs))
@@ -0,0 +1,203 @@
+'''
+Ragged (CSR) test day arrays for lactation-level analysis.
+
+TestDays holds one flat NumPy array per test day field, all lactations
+back to back, and an offsets array with one entry more than there are
+lactations: the tests of lactation k are offsets[k]:offsets[k+1]. The
+per-lactation statistics (peak yield, DIM at peak, least squares slope,
+mean) are computed with ufunc.reduceat over the non-empty lactations, so
+millions of lactations are summarised without a Python loop. MISSING test
+values are left out of every statistic; lactations without a usable test
+get MISSING (peaks) or NaN (slopes, means).
+
+read_test_days decodes a whole fmt4 file (or a compressed one) into a
+TestDays; TestDays(seg_columns, seg_index) also wraps a decode_batch result
+or an fmt4_columnar export.
+'''
+
+import argparse
+import csv
+
+import numpy as np
+
+from fmt4_decode import decode_batch, record_batches
+from fmt4_layout import MISSING, segment_projection
+from fmt4_reader import open_fmt4
+
+TEST_DAY_FIELDS = ['dim_test', 'actual_milk_yield', 'actual_fat_percent', 'actual_protein_percent', 'actual_SCS']
+
+
+class TestDays(object):
+	'''
+		Description:
+			CSR layout of the test days of many lactations
+		Input:
+			fields: {segment field name: flat array}
+			offsets: int64 array, lactation k owns offsets[k]:offsets[k+1]
+			record_offsets: position of each lactation's record in its fmt4 file, if known
+	'''
+	def __init__(self, fields, offsets, record_offsets=None):
+		self.fields = fields
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.record_offsets = record_offsets
+		self.counts = np.diff(self.offsets)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, name):
+		return self.fields[name]
+
+	def lactation(self, k):
+		'''
+			Description:
+				{field: array} of the tests of lactation k, views into the flat arrays
+		'''
+		start, end = self.offsets[k], self.offsets[k+1]
+		return dict((name, values[start:end]) for name, values in self.fields.items())
+
+	def lactation_ids(self):
+		'''
+			Description:
+				lactation number of every test, for bincount or grouping
+		'''
+		return np.repeat(np.arange(len(self)), self.counts)
+
+	def valid(self, *names):
+		'''
+			Description:
+				tests where none of the named fields is MISSING
+		'''
+		ok = np.ones(self.offsets[-1] - self.offsets[0], dtype=bool)
+		for name in names:
+			ok &= self.fields[name] != MISSING
+		return ok
+
+	def reduce(self, ufunc, values, empty):
+		'''
+			Description:
+				ufunc.reduceat of a flat per-test array over every lactation
+			Input:
+				values: one value per test
+				empty: result of the lactations without tests
+		'''
+		values = np.asarray(values)
+		out = np.full(len(self), empty, dtype=np.result_type(values, np.min_scalar_type(empty)))
+		# reduceat takes the element at the index for an empty segment, so only
+		# the non-empty lactations are reduced: each runs up to the next start
+		nonempty = self.counts > 0
+		if nonempty.any():
+			out[nonempty] = ufunc.reduceat(values, self.offsets[:-1][nonempty] - self.offsets[0])
+		return out
+
+	def count(self, name):
+		'''
+			Description:
+				tests of every lactation with name recorded
+		'''
+		return self.reduce(np.add, self.valid(name).astype(np.int64), 0)
+
+	def peak(self, name='actual_milk_yield', dim_name='dim_test'):
+		'''
+			Description:
+				highest recorded value of every lactation and the DIM of its first
+				test reaching it
+			Output:
+				(peak, dim_at_peak) int arrays, MISSING without a recorded value
+		'''
+		ok = self.valid(name)
+		values = np.where(ok, self.fields[name], MISSING)
+		peak = self.reduce(np.maximum, values, MISSING)
+		n_tests = len(values)
+		at_peak = ok & (values == np.repeat(peak, self.counts))
+		first = self.reduce(np.minimum, np.where(at_peak, np.arange(n_tests), n_tests), n_tests)
+		found = first < n_tests
+		dim_at_peak = np.full(len(self), MISSING, dtype=np.int32)
+		dim_at_peak[found] = self.fields[dim_name][first[found]]
+		return peak, dim_at_peak
+
+	def mean(self, name):
+		'''
+			Description:
+				mean recorded value of every lactation, NaN without one
+		'''
+		ok = self.valid(name)
+		total = self.reduce(np.add, np.where(ok, self.fields[name], 0).astype(np.float64), 0.0)
+		n = self.reduce(np.add, ok.astype(np.float64), 0.0)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return total / n
+
+	def slope(self, name='actual_milk_yield', dim_name='dim_test'):
+		'''
+			Description:
+				least squares slope of name against DIM per lactation, in
+				recorded units per day, NaN with fewer than two distinct DIMs
+		'''
+		ok = self.valid(name, dim_name)
+		x = np.where(ok, self.fields[dim_name], 0).astype(np.float64)
+		y = np.where(ok, self.fields[name], 0).astype(np.float64)
+
+		def total(values):
+			return self.reduce(np.add, values, 0.0)
+
+		n = total(ok.astype(np.float64))
+		sum_x = total(x)
+		sum_y = total(y)
+		denominator = n * total(x * x) - sum_x * sum_x
+		numerator = n * total(x * y) - sum_x * sum_y
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return np.where(denominator > 0, numerator / denominator, np.nan)
+
+	def summary(self, name='actual_milk_yield'):
+		'''
+			Description:
+				{statistic: array} with one entry per lactation
+		'''
+		peak, dim_at_peak = self.peak(name)
+		return {
+			'n_tests': self.count(name),
+			'peak': peak,
+			'dim_at_peak': dim_at_peak,
+			'slope': self.slope(name),
+			'mean_SCS': self.mean('actual_SCS') if 'actual_SCS' in self.fields else np.full(len(self), np.nan),
+		}
+
+
+def read_test_days(path, fields=TEST_DAY_FIELDS, predicate=None, batch_size=100000):
+	'''
+		Description:
+			decode the test days of every record of an fmt4 file (which may be
+			compressed) accepted by predicate into one TestDays
+	'''
+	seg_projection = segment_projection(fields)
+	parts = dict((name, []) for name in seg_projection.names)
+	counts = []
+	record_offsets = []
+	with open_fmt4(path) as reader:
+		for data, offsets, seg_counts, base in record_batches(reader, batch_size, predicate=predicate):
+			columns, seg_columns, seg_index = decode_batch(data, offsets, seg_counts, None, seg_projection)
+			for name in parts:
+				parts[name].append(seg_columns[name])
+			counts.append(seg_counts)
+			record_offsets.append(base + offsets)
+	offsets = np.zeros(sum(len(part) for part in counts) + 1, dtype=np.int64)
+	if counts:
+		np.cumsum(np.concatenate(counts), out=offsets[1:])
+	columns = dict((name, np.concatenate(part) if part else np.empty(0, dtype=np.int32)) for name, part in parts.items())
+	record_offsets = np.concatenate(record_offsets) if record_offsets else np.empty(0, dtype=np.int64)
+	return TestDays(columns, offsets, record_offsets)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='per-lactation test day statistics of an fmt4 file')
+	parser.add_argument('input')
+	parser.add_argument('output', help='csv with one row per lactation')
+	parser.add_argument('--field', default='actual_milk_yield', help='segment field the peak, slope and n_tests are taken of')
+	args = parser.parse_args()
+	test_days = read_test_days(args.input, sorted(set(TEST_DAY_FIELDS + [args.field])))
+	summary = test_days.summary(args.field)
+	with open(args.output, 'w', newline='') as output_f:
+		w = csv.writer(output_f)
+		w.writerow(['record_offset'] + list(summary))
+		w.writerows(zip(test_days.record_offsets.tolist(), *[values.tolist() for values in summary.values()]))
+	print(len(test_days))
@@ -0,0 +1,288 @@
+'''
+Vectorized data quality checks of decoded fmt4 batches.
+
+Every rule maps a decoded batch (fmt4_decode.decode_batch output) to a
+boolean mask of the records that break it; test day rules are evaluated
+on the flat segment arrays and folded back onto their records with
+bincount. A record is rejected when any rule fails. validate_file counts
+the failures of every rule, writes rejected records unchanged (so the
+reject file is itself an fmt4 file) and optionally the accepted records to
+a clean fmt4 file for the converters.
+
+When the records are separated by newlines, validate_file frames them by
+line rather than by their segment count, so a record whose count does not
+match its length (or is not a number) fails segment_count, goes to the
+reject file as it was, and the next line is read normally instead of the
+wrong count swallowing or splitting its neighbours. Files without
+newlines can only be framed by the counts, there a count that is not a
+number still raises Fmt4FormatError.
+'''
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from fmt4_decode import decode_batch, record_batches
+from fmt4_layout import MISSING, MISSING_DATE
+from fmt4_reader import COMPRESSED_MAGIC, NEWLINE_BYTES, SEG_COUNT_OFFSET, SEGMENT_OFFSET, SEGMENT_SIZE, Fmt4BytesReader, open_fmt4
+
+# inclusive (low, high) bounds of the recorded values, MISSING values are not checked
+BOUNDS = {
+	'DIM': (1, 999),
+	'actual_milk_yield': (0, 9999),
+	'lactation_num': (1, 30),
+	'herd_state_code': (1, 99),
+	'num_seg_test_days': (0, 50),
+	# test days: milk in tenths of a pound, fat, protein and SCS in tenths
+	'seg_actual_milk_yield': (1, 2500),
+	'seg_actual_fat_percent': (10, 99),
+	'seg_actual_protein_percent': (10, 70),
+	'seg_actual_SCS': (0, 99),
+}
+
+DOMAINS = {
+	'record_type': b'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+	'lactation_type_code': b'0123456789',
+}
+
+
+def _outside(values, bounds):
+	low, high = bounds
+	return (values != MISSING) & ((values < low) | (values > high))
+
+
+def _per_record(bad_segments, seg_index):
+	n = len(seg_index) - 1
+	record = np.repeat(np.arange(n), np.diff(seg_index))
+	return np.bincount(record[bad_segments], minlength=n) > 0
+
+
+def _bad_dates(columns, seg_columns, seg_index):
+	return (columns['birth_date'] == MISSING_DATE) | (columns['calving_date'] == MISSING_DATE)
+
+
+def _calving_before_birth(columns, seg_columns, seg_index):
+	return ((columns['birth_date'] != MISSING_DATE) & (columns['calving_date'] != MISSING_DATE) &
+		(columns['calving_date'] <= columns['birth_date']))
+
+
+def _dim_range(columns, seg_columns, seg_index):
+	return (columns['DIM'] == MISSING) | _outside(columns['DIM'], BOUNDS['DIM'])
+
+
+def _header_bounds(columns, seg_columns, seg_index):
+	bad = np.zeros(len(seg_index) - 1, dtype=bool)
+	for name in ('actual_milk_yield', 'lactation_num', 'herd_state_code'):
+		bad |= _outside(columns[name], BOUNDS[name])
+	return bad
+
+
+def _segment_count(columns, seg_columns, seg_index):
+	# counts inconsistent with the record length never get here, see Fmt4Validator.misframed
+	return _outside(columns['num_seg_test_days'], BOUNDS['num_seg_test_days'])
+
+
+def _test_day_order(columns, seg_columns, seg_index):
+	dim = seg_columns['dim_test']
+	n_segments = len(dim)
+	first = np.zeros(n_segments, dtype=bool)
+	first[seg_index[:-1][np.diff(seg_index) > 0]] = True
+	bad = (dim == MISSING) | (dim < 1)
+	bad[1:] |= ~first[1:] & (dim[1:] <= dim[:-1])
+	return _per_record(bad, seg_index)
+
+
+def _test_day_past_dim(columns, seg_columns, seg_index):
+	dim = np.repeat(columns['DIM'], np.diff(seg_index))
+	return _per_record((dim != MISSING) & (seg_columns['dim_test'] > dim), seg_index)
+
+
+def _test_day_bounds(columns, seg_columns, seg_index):
+	bad = np.zeros(len(seg_columns['dim_test']), dtype=bool)
+	for name in ('actual_milk_yield', 'actual_fat_percent', 'actual_protein_percent', 'actual_SCS'):
+		bad |= _outside(seg_columns[name], BOUNDS['seg_' + name])
+	return _per_record(bad, seg_index)
+
+
+def _code_domains(columns, seg_columns, seg_index):
+	bad = np.zeros(len(seg_index) - 1, dtype=bool)
+	for name, domain in DOMAINS.items():
+		bad |= ~np.isin(columns[name], np.frombuffer(domain, dtype=np.uint8))
+	breed = np.ascontiguousarray(columns['animal_breed_code']).view(np.uint8).reshape(-1, 2)
+	bad |= ((breed < ord('A')) | (breed > ord('Z'))).any(axis=1)
+	return bad
+
+
+RULES = [
+	('bad_date', _bad_dates),
+	('calving_before_birth', _calving_before_birth),
+	('dim_range', _dim_range),
+	('header_bounds', _header_bounds),
+	('segment_count', _segment_count),
+	('test_day_order', _test_day_order),
+	('test_day_past_dim', _test_day_past_dim),
+	('test_day_bounds', _test_day_bounds),
+	('code_domain', _code_domains),
+]
+
+
+class Fmt4Validator(object):
+	'''
+		Description:
+			applies RULES (or a subset) to decoded batches and counts the
+			records failing each rule, a record failing several rules is
+			counted under each of them
+		Input:
+			rules: rule names to apply, None for all
+	'''
+	def __init__(self, rules=None):
+		known = [name for name, rule in RULES]
+		if rules is not None and set(rules) - set(known):
+			raise ValueError('unknown validation rules {}'.format(sorted(set(rules) - set(known))))
+		self.rules = [(name, rule) for name, rule in RULES if rules is None or name in rules]
+		self.counts = dict((name, 0) for name, rule in self.rules)
+		self.records = 0
+		self.rejected = 0
+		self.misframed_records = 0
+
+	def check(self, columns, seg_columns, seg_index):
+		'''
+			Description:
+				boolean mask of the records of the batch passing every rule
+		'''
+		ok = np.ones(len(seg_index) - 1, dtype=bool)
+		for name, rule in self.rules:
+			bad = rule(columns, seg_columns, seg_index)
+			self.counts[name] += int(np.count_nonzero(bad))
+			ok &= ~bad
+		self.records += len(ok)
+		self.rejected += len(ok) - int(np.count_nonzero(ok))
+		return ok
+
+	def misframed(self, n):
+		'''
+			Description:
+				count n records whose segment count does not frame them, they
+				cannot be decoded and are always rejected
+		'''
+		self.misframed_records += n
+		self.records += n
+		self.rejected += n
+		if 'segment_count' in self.counts:
+			self.counts['segment_count'] += n
+
+	def report(self):
+		return {'records': self.records, 'rejected': self.rejected, 'misframed': self.misframed_records,
+			'rules': dict(self.counts)}
+
+
+def write_records(f, data, offsets, seg_counts):
+	ends = offsets + SEGMENT_OFFSET + SEGMENT_SIZE * seg_counts
+	for start, end in zip(offsets.tolist(), ends.tolist()):
+		f.write(data[start:end].tobytes())
+		f.write(b'\n')
+
+
+def _open_raw(path):
+	with open(path, 'rb') as f:
+		magic = f.read(6)
+	for prefix, opener in COMPRESSED_MAGIC:
+		if magic.startswith(prefix):
+			return opener(path, 'rb')
+	return open(path, 'rb')
+
+
+def _newline_separated(path):
+	# a newline within the longest possible record (99 segments)
+	with _open_raw(path) as f:
+		head = f.read(SEGMENT_OFFSET + SEGMENT_SIZE * 99 + 2)
+	return any(byte in NEWLINE_BYTES for byte in head)
+
+
+def _frames(line):
+	count = line[SEG_COUNT_OFFSET:SEG_COUNT_OFFSET+2]
+	return len(line) >= SEGMENT_OFFSET and count.isdigit() and len(line) == SEGMENT_OFFSET + SEGMENT_SIZE * int(count)
+
+
+def _line_batches(path, batch_size, predicate):
+	'''
+		Description:
+			yield (records, misframed) per batch_size lines: the bytes of the
+			records framed by their line, newline separated, and the lines
+			whose segment count does not match their length
+	'''
+	records = []
+	misframed = []
+	with _open_raw(path) as f:
+		for line in f:
+			line = line.rstrip(b'\r\n')
+			if not line:
+				continue
+			# the filter reads header bytes only, so it also sees misframed records
+			if predicate is not None and len(line) >= SEGMENT_OFFSET and not predicate(line, 0):
+				continue
+			(records if _frames(line) else misframed).append(line)
+			if len(records) + len(misframed) >= batch_size:
+				yield b'\n'.join(records), misframed
+				records = []
+				misframed = []
+	if records or misframed:
+		yield b'\n'.join(records), misframed
+
+
+def _check_batches(validator, reader, batch_size, predicate, reject_f, clean_f):
+	for data, offsets, seg_counts, base in record_batches(reader, batch_size, predicate=predicate):
+		offsets = np.asarray(offsets, dtype=np.int64)
+		seg_counts = np.asarray(seg_counts, dtype=np.int64)
+		ok = validator.check(*decode_batch(data, offsets, seg_counts))
+		if reject_f is not None:
+			write_records(reject_f, data, offsets[~ok], seg_counts[~ok])
+		if clean_f is not None:
+			write_records(clean_f, data, offsets[ok], seg_counts[ok])
+
+
+def validate_file(path, reject_path=None, clean_path=None, rules=None, predicate=None, batch_size=100000):
+	'''
+		Description:
+			validate every record of an fmt4 file (which may be compressed)
+		Input:
+			reject_path: fmt4 file receiving the rejected records
+			clean_path: fmt4 file receiving the accepted records
+			predicate: Fmt4Filter (or any reader predicate) applied before validating
+		Output:
+			Fmt4Validator holding the counters
+	'''
+	validator = Fmt4Validator(rules)
+	reject_f = open(reject_path, 'wb') if reject_path else None
+	clean_f = open(clean_path, 'wb') if clean_path else None
+	try:
+		if _newline_separated(path):
+			for records, misframed in _line_batches(path, batch_size, predicate):
+				validator.misframed(len(misframed))
+				if reject_f is not None:
+					for line in misframed:
+						reject_f.write(line + b'\n')
+				with Fmt4BytesReader(records, path) as reader:
+					_check_batches(validator, reader, batch_size, None, reject_f, clean_f)
+		else:
+			with open_fmt4(path) as reader:
+				_check_batches(validator, reader, batch_size, predicate, reject_f, clean_f)
+	finally:
+		for f in (reject_f, clean_f):
+			if f is not None:
+				f.close()
+	return validator
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='check fmt4 records and report rule failures')
+	parser.add_argument('input')
+	parser.add_argument('--rejects', help='write the rejected records to this fmt4 file')
+	parser.add_argument('--clean', help='write the accepted records to this fmt4 file')
+	parser.add_argument('--rules', help='comma separated subset of ' + ','.join(name for name, rule in RULES))
+	args = parser.parse_args()
+	validator = validate_file(args.input, args.rejects, args.clean, args.rules.split(',') if args.rules else None)
+	json.dump(validator.report(), sys.stdout, indent=1)
+	print()
@@ -0,0 +1,193 @@
+'''
+Batch fitting of Wood's lactation curve to fmt4 test day milk yields.
+
+Wood's curve y = l * t^m * exp(-n t) is linear after taking logs,
+	log y = log l + m log t - n t
+so every lactation is an ordinary least squares fit over its test days.
+The 3x3 normal equations of all lactations of a batch are built at once
+with bincount over the ragged test day arrays and solved by one batched
+np.linalg.solve. Fits are then summarised per breed x parity (1, 2, 3+)
+into the l, m, n, l_std, m_std, n_std block of the simulation's
+config.json, the stds being the spread of the per-lactation parameters.
+'''
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from fmt4_decode import iter_lactations
+from fmt4_layout import MISSING
+
+BREEDS = ('HO', 'JE')
+PARITIES = 3
+# test day milk is recorded in tenths of a pound, the simulation works in kg
+YIELD_SCALE = 0.1 * 0.45359237
+# days are scaled down in the normal equations to keep them well conditioned
+_DAY_SCALE = 100.0
+
+
+def fit_wood(dim, milk, seg_index, min_tests=4, yield_scale=YIELD_SCALE):
+	'''
+		Description:
+			least squares fit of Wood's curve to each lactation of a batch
+		Input:
+			dim, milk: flat test day DIM and milk yield arrays
+			seg_index: CSR index, seg_index[k]:seg_index[k+1] are the tests of lactation k
+			min_tests: lactations with fewer usable tests are not fitted
+			yield_scale: factor from the recorded milk unit to the fitted unit
+		Output:
+			(l, m, n, ok) arrays, ok False where no fit was possible
+	'''
+	seg_index = np.asarray(seg_index, dtype=np.int64)
+	n_lactations = len(seg_index) - 1
+	lactation = np.repeat(np.arange(n_lactations), np.diff(seg_index))
+	usable = (dim != MISSING) & (dim > 0) & (milk != MISSING) & (milk > 0)
+	lactation = lactation[usable]
+	t = dim[usable] / _DAY_SCALE
+	log_t = np.log(t)
+	y = np.log(milk[usable] * yield_scale)
+
+	def total(weights=None):
+		return np.bincount(lactation, weights, minlength=n_lactations)
+
+	count = total()
+	sum_log_t = total(log_t)
+	sum_t = total(t)
+	normal = np.empty((n_lactations, 3, 3))
+	normal[:, 0, 0] = count
+	normal[:, 0, 1] = normal[:, 1, 0] = sum_log_t
+	normal[:, 0, 2] = normal[:, 2, 0] = -sum_t
+	normal[:, 1, 1] = total(log_t * log_t)
+	normal[:, 1, 2] = normal[:, 2, 1] = -total(log_t * t)
+	normal[:, 2, 2] = total(t * t)
+	rhs = np.stack([total(y), total(y * log_t), -total(y * t)], axis=1)
+
+	# singular systems (too few or repeated test days) are left out of the solve
+	diagonal = np.prod(np.abs(np.diagonal(normal, axis1=1, axis2=2)), axis=1)
+	ok = (count >= max(min_tests, 3)) & (np.abs(np.linalg.det(normal)) > 1e-10 * diagonal)
+	coef = np.full((n_lactations, 3), np.nan)
+	if ok.any():
+		coef[ok] = np.linalg.solve(normal[ok], rhs[ok][:, :, None])[:, :, 0]
+	l = np.exp(coef[:, 0]) * _DAY_SCALE ** -coef[:, 1]
+	return l, coef[:, 1], coef[:, 2] / _DAY_SCALE, ok
+
+
+def group_index(breed, lactation_num, breeds=BREEDS):
+	'''
+		Description:
+			breed x parity group of each lactation, -1 outside breeds or without parity
+	'''
+	breed_index = np.full(len(breed), -1, dtype=np.int64)
+	for k, code in enumerate(breeds):
+		breed_index[breed == code.encode('ascii')] = k
+	parity_index = np.minimum(lactation_num, PARITIES) - 1
+	return np.where((breed_index >= 0) & (lactation_num > 0), breed_index * PARITIES + parity_index, -1)
+
+
+class WoodSummary(object):
+	'''
+		Description:
+			per breed x parity count, sum and sum of squares of the fitted
+			parameters, summaries of different batches or files can be merged
+	'''
+	def __init__(self, breeds=BREEDS):
+		self.breeds = tuple(breeds)
+		self.count = np.zeros(len(self.breeds) * PARITIES)
+		self.sums = np.zeros((3, len(self.count)))
+		self.squares = np.zeros((3, len(self.count)))
+
+	def add(self, group, params):
+		keep = group >= 0
+		size = len(self.count)
+		self.count += np.bincount(group[keep], minlength=size)
+		for k, values in enumerate(params):
+			self.sums[k] += np.bincount(group[keep], values[keep], minlength=size)
+			self.squares[k] += np.bincount(group[keep], values[keep] ** 2, minlength=size)
+
+	def merge(self, other):
+		self.count += other.count
+		self.sums += other.sums
+		self.squares += other.squares
+
+	def config(self):
+		'''
+			Description:
+				config.json compatible {'l': [[...]], ..., 'n_std': [[...]]}, indexed [breed][parity]
+		'''
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = self.sums / self.count
+			std = np.sqrt(np.maximum(self.squares / self.count - mean ** 2, 0) * self.count / (self.count - 1))
+		block = {}
+		for k, name in enumerate(('l', 'm', 'n')):
+			block[name] = _nested(mean[k], len(self.breeds))
+			block[name + '_std'] = _nested(std[k], len(self.breeds))
+		block['wood_fit_counts'] = _nested(self.count.astype(np.int64), len(self.breeds))
+		return block
+
+
+def _nested(values, n_breeds):
+	return [[None if isinstance(v, float) and np.isnan(v) else v for v in row]
+		for row in values.reshape(n_breeds, PARITIES).tolist()]
+
+
+def fit_file(path, predicate=None, min_tests=4, yield_scale=YIELD_SCALE, peaked_only=True, batch_size=100000, breeds=BREEDS):
+	'''
+		Description:
+			fit every lactation of an fmt4 file and summarise the fits
+		Input:
+			predicate: Fmt4Filter (or any reader predicate) applied before decoding
+			peaked_only: keep only fits with m > 0 and n > 0, i.e. curves with a peak
+		Output:
+			WoodSummary
+	'''
+	summary = WoodSummary(breeds)
+	for columns, seg_columns, seg_index in iter_lactations(path, ['animal_breed_code', 'lactation_num'],
+			['dim_test', 'actual_milk_yield'], batch_size, predicate):
+		l, m, n, ok = fit_wood(seg_columns['dim_test'], seg_columns['actual_milk_yield'], seg_index, min_tests, yield_scale)
+		if peaked_only:
+			ok &= (m > 0) & (n > 0)
+		group = group_index(columns['animal_breed_code'], columns['lactation_num'], breeds)
+		group[~ok] = -1
+		summary.add(group, (l, m, n))
+	return summary
+
+
+def wood_config(paths, **kwargs):
+	'''
+		Description:
+			config.json block of Wood parameters fitted over all fmt4 files in paths,
+			at least one
+	'''
+	if not paths:
+		# an empty summary would put null parameters into config.json
+		raise ValueError('no fmt4 files to fit')
+	summary = None
+	for path in paths:
+		file_summary = fit_file(path, **kwargs)
+		if summary is None:
+			summary = file_summary
+		else:
+			summary.merge(file_summary)
+	return summary.config()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="fit Wood's lactation curves to fmt4 test day milk yields")
+	parser.add_argument('inputs', nargs='+')
+	parser.add_argument('--min-tests', type=int, default=4, help='least usable test days to fit a lactation')
+	parser.add_argument('--yield-scale', type=float, default=YIELD_SCALE,
+		help='factor from the recorded milk unit to the fitted unit, default tenths of a pound to kg')
+	parser.add_argument('--keep-unpeaked', action='store_true', help='also keep fits with m <= 0 or n <= 0')
+	parser.add_argument('--update-config', help='config.json whose l, m, n and std entries are replaced')
+	args = parser.parse_args()
+	block = wood_config(args.inputs, min_tests=args.min_tests, yield_scale=args.yield_scale, peaked_only=not args.keep_unpeaked)
+	if args.update_config:
+		with open(args.update_config) as f:
+			config = json.load(f)
+		config.update((key, value) for key, value in block.items() if key != 'wood_fit_counts')
+		with open(args.update_config, 'w') as f:
+			json.dump(config, f, indent='\t')
+	json.dump(block, sys.stdout, indent=1)
+	print()